@@ -0,0 +1,143 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from anomaly_detection.baseline import CACHE_DIR
+from anomaly_detection.clickhouse import ClickHouseClient, connection_from_env
+from anomaly_detection.engine import replay
+from anomaly_detection.history import HISTORY_DAYS, history_days, load_history, update_history
+from anomaly_detection.metrics import METRICS, RESOLUTIONS, check_resolutions, metrics_by_table
+from anomaly_detection.queries import HALF_LIFE_WEEKS
+from anomaly_detection.rollup import fresh_rollups
+
+logger = logging.getLogger(__name__)
+
+# the backtests keep their own history, so replaying past days never evicts
+# the days the detection of the DAG reads
+BACKTEST_CACHE_DIR = os.path.join(CACHE_DIR, 'backtest')
+
+REPORT_COLUMNS = ['resolution', 'sigma', 'metric_name', 'checked', 'alerts', 'alerts_per_day', 'true_alerts', 'precision',
+                  'incidents', 'detected_incidents', 'recall']
+
+
+def replay_alerts(client, start, end, metrics=METRICS, sigmas=None, cache_dir=BACKTEST_CACHE_DIR,
+                  days=HISTORY_DAYS, half_life_weeks=HALF_LIFE_WEEKS):
+    # every interval of every resolution of the days from `start` to `end` (excluded) is
+    # checked against the baseline of the `days` days before it, the lookback window of the
+    # DAG; `sigmas` replaces the sigma of every metric, the alerts are returned for each of them
+    evaluated_days = (end - start).days
+    tables = metrics_by_table(metrics)
+    update_history(client, end, metrics, fresh_rollups(client, tables), cache_dir, evaluated_days + days)
+
+    dates = np.array(history_days(end, evaluated_days + days))
+    evaluated = dates >= start
+
+    frames, checked = [], {}
+    for table_metrics, resolution in [(table_metrics, resolution) for table_metrics in tables.values()
+                                      for resolution in check_resolutions(RESOLUTIONS)]:
+        values, weekdays = load_history(end, table_metrics, resolution, cache_dir, evaluated_days + days)
+
+        for sigma in sigmas or [None]:
+            metric_sigmas = np.array([metric.sigma if sigma is None else sigma for metric in table_metrics], dtype=float)
+            table_checked, anomaly = replay(values, weekdays, metric_sigmas, days, half_life_weeks)
+            table_checked, anomaly = table_checked[evaluated], anomaly[evaluated]
+
+            day_indexes, slots, metric_indexes = np.nonzero(anomaly)
+            frames.append(pd.DataFrame({
+                'resolution': resolution,
+                'sigma': metric_sigmas[metric_indexes],
+                'metric_name': np.array([metric.name for metric in table_metrics])[metric_indexes],
+                'time': pd.to_datetime(dates[evaluated][day_indexes])
+                        + pd.to_timedelta(slots * resolution, unit='min'),
+            }))
+            for i, metric in enumerate(table_metrics):
+                checked[(resolution, metric_sigmas[i], metric.name)] = int(table_checked[:, :, i].sum())
+
+    alerts = pd.concat(frames, ignore_index=True).sort_values(['resolution', 'sigma', 'metric_name', 'time'],
+                                                              ignore_index=True)
+    return alerts, checked
+
+
+def read_incidents(path, metrics=METRICS):
+    # the labelled incidents are a CSV file with the metric_name, start and end
+    # columns, an incident without a metric name concerns all the metrics
+    incidents = pd.read_csv(path, parse_dates=['start', 'end'])
+    everywhere = incidents[incidents.metric_name.isna()].drop(columns='metric_name')
+    everywhere = everywhere.merge(pd.DataFrame({'metric_name': [metric.name for metric in metrics]}), how='cross')
+    incidents = pd.concat([incidents[incidents.metric_name.notna()], everywhere], ignore_index=True)
+    return incidents[['metric_name', 'start', 'end']]
+
+
+def evaluate(alerts, checked, incidents, evaluated_days):
+    # an alert is true when its interval overlaps an incident of its metric
+    # and an incident is detected when at least one alert overlaps it
+    alerts = alerts.reset_index(drop=True)
+    incidents = incidents.reset_index(drop=True).rename_axis('incident').reset_index()
+    pairs = alerts.reset_index().merge(incidents, on='metric_name')
+    pairs = pairs[(pairs.time < pairs.end)
+                  & (pairs.time + pd.to_timedelta(pairs.resolution, unit='min') > pairs.start)]
+    alerts['true_alert'] = alerts.index.isin(pairs['index'])
+
+    rows = []
+    for (resolution, sigma, metric_name), count in checked.items():
+        metric_alerts = alerts[(alerts.resolution == resolution) & (alerts.sigma == sigma)
+                               & (alerts.metric_name == metric_name)]
+        metric_pairs = pairs[(pairs.resolution == resolution) & (pairs.sigma == sigma)
+                             & (pairs.metric_name == metric_name)]
+        metric_incidents = incidents[incidents.metric_name == metric_name]
+        rows.append({
+            'resolution': resolution,
+            'sigma': sigma,
+            'metric_name': metric_name,
+            'checked': count,
+            'alerts': len(metric_alerts),
+            'alerts_per_day': round(len(metric_alerts) / max(evaluated_days, 1), 2),
+            'true_alerts': int(metric_alerts.true_alert.sum()),
+            'precision': round(metric_alerts.true_alert.mean(), 3) if len(metric_alerts) else np.nan,
+            'incidents': len(metric_incidents),
+            'detected_incidents': metric_pairs.incident.nunique(),
+            'recall': round(metric_pairs.incident.nunique() / len(metric_incidents), 3)
+            if len(metric_incidents) else np.nan,
+        })
+    return pd.DataFrame(rows, columns=REPORT_COLUMNS), alerts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays the anomaly detection over past days, every interval '
+                                                 'being checked against the days before it')
+    parser.add_argument('--start', type=lambda value: pd.Timestamp(value).date(), required=True,
+                        help='first replayed day')
+    parser.add_argument('--end', type=lambda value: pd.Timestamp(value).date(), default=pd.Timestamp.today().date(),
+                        help='day the replay stops before, today by default')
+    parser.add_argument('--sigma', type=float, nargs='+',
+                        help='sigmas replacing the ones of the metrics, each of them is replayed')
+    parser.add_argument('--incidents', help='CSV file of the labelled incidents (metric_name, start, end)')
+    parser.add_argument('--alerts', help='CSV file to write the raised alerts to')
+    args = parser.parse_args()
+
+    if args.start >= args.end:
+        parser.error('--start must be before --end')
+
+    logging.basicConfig(level=logging.INFO)
+    with ClickHouseClient(connection_from_env()) as client:
+        # the first backtest fetches the whole history, so it is not limited by the query timeout
+        client.timeout = 3600
+        started = time.monotonic()
+        alerts, checked = replay_alerts(client, args.start, args.end, sigmas=args.sigma)
+
+    incidents = read_incidents(args.incidents) if args.incidents else \
+        pd.DataFrame(columns=['metric_name', 'start', 'end'])
+    report, alerts = evaluate(alerts, checked, incidents, (args.end - args.start).days)
+    logger.info('Replayed %s days in %.1f seconds', (args.end - args.start).days, time.monotonic() - started)
+
+    print(report.to_string(index=False))
+    if args.alerts:
+        alerts.to_csv(args.alerts, index=False)
+
+
+if __name__ == '__main__':
+    main()
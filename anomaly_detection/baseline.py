@@ -0,0 +1,81 @@
+import logging
+import os
+import time
+from datetime import timedelta
+
+import pandas as pd
+
+from anomaly_detection.clickhouse import ClickHouseError
+from anomaly_detection.metrics import METRICS, definition_hash, metrics_by_table
+from anomaly_detection.queries import HALF_LIFE_WEEKS, LOOKBACK_WEEKS, baseline_params, baseline_queries
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get('ANOMALY_DETECTION_CACHE_DIR', '/tmp/anomaly_detection')
+# hours a cached baseline is used for before it is calculated again, e.g. to take in the
+# events of the previous day which have arrived late; a baseline is never kept past its day
+BASELINE_TTL_HOURS = float(os.environ.get('ANOMALY_DETECTION_BASELINE_TTL_HOURS', 24))
+
+# the baseline is cached indexed by the key the current values are looked up with,
+# so a run only picks the rows of its intervals instead of merging the whole baseline
+BASELINE_KEY = ['metric_name', 'resolution', 'weekday', 'time']
+
+
+def baseline_path(day, table, table_metrics, cache_dir=CACHE_DIR):
+    # the path changes every day and whenever the metrics of the table or the window are redefined
+    return os.path.join(cache_dir, 'baseline', table, f'{day.isoformat()}-{definition_hash(table_metrics)}'
+                                                      f'-{LOOKBACK_WEEKS}w{HALF_LIFE_WEEKS:g}.bounds.pkl')
+
+
+def is_fresh(path, ttl_hours=BASELINE_TTL_HOURS):
+    return os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl_hours * 3600
+
+
+def save_baseline(baseline, path, day):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # writing through a temporary file so a concurrent run never reads a partial baseline
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    baseline.set_index(BASELINE_KEY).sort_index().to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+    # the baselines of the other definitions of the day and of the days before the previous
+    # one are not needed anymore; the previous day is still checked by the first run after
+    # the midnight and by a catch-up (see anomaly_detection.catchup)
+    previous_day = (day - timedelta(days=1)).isoformat()
+    for file_name in os.listdir(os.path.dirname(path)):
+        if file_name.endswith('.pkl') and file_name != os.path.basename(path) \
+                and (file_name[:10] < previous_day or file_name.startswith(day.isoformat())):
+            os.remove(os.path.join(os.path.dirname(path), file_name))
+
+
+def build_baselines(client, day, metrics=METRICS, rollup_tables=(), cache_dir=CACHE_DIR,
+                    ttl_hours=BASELINE_TTL_HOURS):
+    # calculating the baselines of the tables which are not cached or have expired,
+    # all of them at once; the paths of the baselines of all the tables are returned
+    day = pd.Timestamp(day).date()
+    tables = metrics_by_table(metrics)
+    paths = {table: baseline_path(day, table, table_metrics, cache_dir)
+             for table, table_metrics in tables.items()}
+
+    missing = [table for table, path in paths.items() if not is_fresh(path, ttl_hours)]
+    if missing:
+        # the query cache of the server keeps the results as long as the cached baselines are
+        # used, so the other workers (or this one after losing its cache) do not calculate them again
+        queries = baseline_queries([metric for table in missing for metric in tables[table]], rollup_tables,
+                                   cache_ttl_seconds=ttl_hours * 3600)
+        results, errors = client.read_many(queries, baseline_params(day.isoformat()))
+        for table, baseline in results.items():
+            save_baseline(baseline, paths[table], day)
+            logger.info('Calculated the baseline of %s for %s', table, day)
+        if errors:
+            # the failed tables are calculated again by the next run
+            raise ClickHouseError('Baseline queries failed for ' + ', '.join(errors))
+    return paths
+
+
+def load_baseline(client, day, metrics=METRICS, rollup_tables=(), cache_dir=CACHE_DIR):
+    # the baseline only depends on the days before `day`, so it is calculated
+    # by the warm-up or the first run of the day for every table and reused by the rest;
+    # it is indexed by BASELINE_KEY
+    paths = build_baselines(client, day, metrics, rollup_tables, cache_dir)
+    return pd.concat([pd.read_pickle(path) for path in paths.values()])
@@ -0,0 +1,260 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import urlparse
+
+from anomaly_detection.clickhouse import ClickHouseClient, connection_from_env
+from anomaly_detection.detection import BASELINE_SOURCE, detect_anomalies
+from anomaly_detection.instrumentation import STATS, record_query
+from anomaly_detection.metrics import (FEED_ACTIONS, MESSAGE_ACTIONS, METRICS, RESOLUTIONS, SLICE_DIMENSIONS,
+                                       metrics_by_table)
+from anomaly_detection.queries import LOOKBACK_WEEKS
+from anomaly_detection.results import write_results
+
+logger = logging.getLogger(__name__)
+
+# the synthetic events follow a daily cycle peaking at noon and a quieter weekend,
+# with some noise around the rate of every minute
+DAILY_AMPLITUDE = 0.5
+WEEKEND_FACTOR = 0.8
+NOISE = 0.2
+
+SEASONALITY = f"""(1 + {DAILY_AMPLITUDE} * sin(2 * pi() * (toHour(minute) * 60 + toMinute(minute) - 360) / 1440))
+                  * if(toDayOfWeek(minute) >= 6, {WEEKEND_FACTOR}, 1)
+                  * (1 - {NOISE} / 2 + {NOISE} * rand(0) / 4294967295)"""
+
+# the events of every minute of the `days` days before the current minute,
+# generated by the server itself, so a year of events is not sent over the network
+MINUTES = """
+        (SELECT toStartOfMinute(now()) - toIntervalMinute(number + 1) AS minute
+        FROM numbers({days} * 1440))
+        ARRAY JOIN range(toUInt32({events_per_second} * 60 * {seasonality})) AS event"""
+
+DIMENSIONS = """['Russia', 'Ukraine', 'Belarus', 'Kazakhstan'][rand(11) % 4 + 1] AS country,
+                ['Android', 'iOS'][rand(12) % 2 + 1] AS os,
+                ['ads', 'organic'][rand(13) % 2 + 1] AS source"""
+
+TABLES = {
+    FEED_ACTIONS: {
+        'columns': 'user_id UInt32, post_id UInt32, action String, time DateTime, country String, os String, '
+                   'source String',
+        'select': """
+        SELECT rand(1) % {users} AS user_id,
+                rand(2) % 1000 AS post_id,
+                if(rand(3) % 5 = 0, 'like', 'view') AS action,
+                minute + toIntervalSecond(rand(4) % 60) AS time,
+                {dimensions}
+        FROM {minutes}""",
+    },
+    MESSAGE_ACTIONS: {
+        'columns': 'user_id UInt32, receiver_id UInt32, time DateTime, country String, os String, source String',
+        'select': """
+        SELECT rand(1) % {users} AS user_id,
+                rand(2) % {users} AS receiver_id,
+                minute + toIntervalSecond(rand(4) % 60) AS time,
+                {dimensions}
+        FROM {minutes}""",
+    },
+}
+
+CREATE_TABLE_QUERY = """
+    CREATE TABLE {table} ({columns})
+    ENGINE = MergeTree
+    PARTITION BY toYYYYMM(time)
+    ORDER BY time
+    """
+
+
+class ChdbResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+class ChdbClient(ClickHouseClient):
+    # runs the queries in an embedded chDB session instead of a server (needs chdb)
+    def __init__(self, path, **kwargs):
+        super().__init__({'host': None}, **kwargs)
+        from chdb import session
+
+        self.chdb_session = session.Session(path)
+        # the session is shared by the threads of read_many, and the query parameters
+        # are set on the whole session, so the queries run one at a time
+        self.lock = threading.Lock()
+        # '%M' of formatDateTime is the minute, as on the servers the queries are written for
+        self.chdb_session.query('SET formatdatetime_parsedatetime_m_is_month_name = 0')
+
+    def execute(self, query, timeout=None, params=None):
+        started = time.perf_counter()
+        with self.lock:
+            content = self.chdb_session.query(query, params=params).bytes()
+        record_query(str(uuid.uuid4()), query, time.perf_counter() - started)
+        return ChdbResponse(content)
+
+
+def generate(client, days, events_per_second, users):
+    # replacing the tables of the metrics with the synthetic events
+    generated = {}
+    for table, definition in TABLES.items():
+        # events of messages are rarer than the ones of the feed
+        rate = events_per_second if table == FEED_ACTIONS else events_per_second / 5
+        started = time.perf_counter()
+        client.execute(f"CREATE DATABASE IF NOT EXISTS {table.split('.')[0]}")
+        client.execute(f'DROP TABLE IF EXISTS {table}')
+        client.execute(CREATE_TABLE_QUERY.format(table=table, columns=definition['columns']))
+        client.execute(f'INSERT INTO {table}' + definition['select'].format(
+            users=users, dimensions=DIMENSIONS,
+            minutes=MINUTES.format(days=days, events_per_second=rate, seasonality=SEASONALITY)))
+        rows = int(client.read(f'SELECT count() AS event_count FROM {table}').event_count[0])
+        generated[table] = {'rows': rows, 'seconds': round(time.perf_counter() - started, 3)}
+        logger.info('Generated %s events of %s in %.1f seconds', rows, table, generated[table]['seconds'])
+    return generated
+
+
+def clear_cache(cache_dir):
+    for kind in ('baseline', 'history', 'slices', 'fitted'):
+        shutil.rmtree(os.path.join(cache_dir, kind), ignore_errors=True)
+
+
+def detect_table(client, table_metrics, results_uri, cache_dir):
+    # what the anomaly_detecter task does for a table
+    write_results(detect_anomalies(client, table_metrics, cache_dir=cache_dir), table_metrics[0].table, results_uri)
+
+
+def time_run(client, results_uri, cache_dir, metrics=METRICS):
+    # the stages are the queries by their template and the parsing of their results
+    STATS.reset()
+    tables = {}
+    for table, table_metrics in metrics_by_table(metrics).items():
+        started = time.perf_counter()
+        detect_table(client, table_metrics, results_uri, cache_dir)
+        tables[table] = time.perf_counter() - started
+
+    return {'seconds': sum(tables.values()),
+            'tables': tables,
+            'stages': {stage: {'queries': sum(query['stage'] == stage for query in STATS.queries), 'seconds': seconds}
+                       for stage, seconds in STATS.stages.items()}}
+
+
+def median_run(runs):
+    # the median of every timing of the runs
+    def median(values):
+        return round(statistics.median(values), 4)
+
+    return {'seconds': median([run['seconds'] for run in runs]),
+            'tables': {table: median([run['tables'][table] for run in runs]) for table in runs[0]['tables']},
+            'stages': {stage: {'queries': runs[0]['stages'][stage]['queries'],
+                               'seconds': median([run['stages'].get(stage, {'seconds': 0})['seconds']
+                                                  for run in runs])}
+                       for stage in runs[0]['stages']}}
+
+
+def benchmark(client, runs=3, per_metric=False, metrics=METRICS):
+    # a cold run computes the baseline of the day, the warm runs read it from the cache
+    # like every later run of the DAG does; the cache is a directory of the benchmark,
+    # so the caches of a worker it runs on are left as they are
+    with tempfile.TemporaryDirectory() as results_uri, tempfile.TemporaryDirectory() as cache_dir:
+        clear_cache(cache_dir)
+        report = {'cold': median_run([time_run(client, results_uri, cache_dir, metrics)]),
+                  'warm': median_run([time_run(client, results_uri, cache_dir, metrics) for _ in range(runs)])}
+
+        if per_metric:
+            report['metrics'] = {}
+            for metric in metrics:
+                clear_cache(cache_dir)
+                cold = time_run(client, results_uri, cache_dir, [metric])['seconds']
+                warm = time_run(client, results_uri, cache_dir, [metric])['seconds']
+                report['metrics'][metric.name] = {'cold': round(cold, 4), 'warm': round(warm, 4)}
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    # the changes of the timings since a previous report
+    def line(name, before, after):
+        change = f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
+        return f'{name}: {before:.3f} s -> {after:.3f} s ({change})'
+
+    lines = []
+    for run in ('cold', 'warm'):
+        if run not in previous:
+            continue
+        lines.append(line(f'{run} run', previous[run]['seconds'], current[run]['seconds']))
+        for table in current[run]['tables']:
+            if table in previous[run]['tables']:
+                lines.append(line(f'  {table}', previous[run]['tables'][table], current[run]['tables'][table]))
+        for stage in current[run]['stages']:
+            if stage in previous[run]['stages']:
+                lines.append(line(f'  {stage} queries', previous[run]['stages'][stage]['seconds'],
+                                  current[run]['stages'][stage]['seconds']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the anomaly detection end to end on synthetic events, '
+                                                 'per table, per query stage and optionally per metric')
+    parser.add_argument('--chdb', metavar='PATH', help='run the queries in an embedded chDB database at PATH '
+                                                       'instead of the ClickHouse server of CLICKHOUSE_HOST')
+    parser.add_argument('--generate', action='store_true',
+                        help='replace the tables of the metrics with synthetic events first')
+    parser.add_argument('--days', type=int, default=28, help='days of generated events (28 by default)')
+    parser.add_argument('--events-per-second', type=float, default=10,
+                        help='average feed events per second, the messages are 5 times rarer (10 by default)')
+    parser.add_argument('--users', type=int, default=10000, help='number of distinct users (10000 by default)')
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='allow --generate to replace the tables of a server which is not local')
+    parser.add_argument('--runs', type=int, default=3, help='number of warm runs (3 by default)')
+    parser.add_argument('--per-metric', action='store_true', help='also time every metric checked on its own')
+    parser.add_argument('--output', default='benchmark.json', help='JSON report to write')
+    parser.add_argument('--compare', help='previous JSON report to compare the timings with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.chdb:
+        client = ChdbClient(args.chdb)
+    else:
+        connection = connection_from_env()
+        if args.generate and not args.allow_remote \
+                and urlparse(connection['host']).hostname not in ('localhost', '127.0.0.1', '::1'):
+            parser.error('--generate replaces the tables of the metrics, use a local server or --allow-remote')
+        client = ClickHouseClient(connection)
+
+    with client:
+        generated = generate(client, args.days, args.events_per_second, args.users) if args.generate else None
+        report = {'commit': git_commit(),
+                  'created': datetime.now().isoformat(timespec='seconds'),
+                  'settings': {'engine': 'chdb' if args.chdb else 'clickhouse',
+                               'days': args.days if args.generate else None,
+                               'events_per_second': args.events_per_second if args.generate else None,
+                               'resolutions': RESOLUTIONS,
+                               'baseline_source': BASELINE_SOURCE,
+                               'lookback_weeks': LOOKBACK_WEEKS,
+                               'slice_dimensions': SLICE_DIMENSIONS},
+                  'generated': generated,
+                  **benchmark(client, args.runs, args.per_metric)}
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps({run: report[run] for run in ('cold', 'warm')}, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            print(compare(json.load(file), report))
+
+
+if __name__ == '__main__':
+    main()
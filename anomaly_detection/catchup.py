@@ -0,0 +1,68 @@
+import logging
+import os
+import uuid
+
+import pyarrow as pa
+import pyarrow.fs
+
+from anomaly_detection.metrics import SCHEDULE_MINUTES
+from anomaly_detection.results import RESULTS_URI, filesystem_from_uri
+
+logger = logging.getLogger(__name__)
+
+# hours of missed runs a run checks the intervals of besides its own ones, e.g. after the
+# scheduler or ClickHouse was down; the older intervals stay unchecked, 0 for no catch-up
+CATCHUP_HOURS = float(os.environ.get('ANOMALY_DETECTION_CATCHUP_HOURS', 24))
+
+# every table has the end of the last interval it was checked up to, written once the results
+# of the table are written, so a failed table catches up on its own; the marks are kept next to
+# the results, which every worker reaches, as the mapped tasks of a table run on any of them;
+# with the default local RESULTS_URI they are only shared by the tasks of a single worker
+
+
+def schedule_start(time, schedule_minutes=SCHEDULE_MINUTES):
+    # the Unix time of the start of the schedule interval of `time`
+    # (a datetime, e.g. the data_interval_end of a run)
+    seconds = schedule_minutes * 60
+    return int(time.timestamp()) // seconds * seconds
+
+
+def mark_path(table, uri=RESULTS_URI):
+    filesystem, directory = filesystem_from_uri(uri)
+    return filesystem, f'{directory}/checked/{table}'
+
+
+def last_checked(table, uri=RESULTS_URI):
+    filesystem, path = mark_path(table, uri)
+    if filesystem.get_file_info(path).type != pa.fs.FileType.File:
+        return None
+    with filesystem.open_input_stream(path) as source:
+        return int(source.read().decode().strip())
+
+
+def catchup_start(table, end, uri=RESULTS_URI, catchup_hours=CATCHUP_HOURS, schedule_minutes=SCHEDULE_MINUTES):
+    # the start of the intervals the run ending at `end` checks: the end of the last checked
+    # ones, at most `catchup_hours` before; the intervals of the run itself are always checked,
+    # so a retried or a manually triggered run checks them again
+    own_start = end - schedule_minutes * 60
+    checked = last_checked(table, uri)
+    if checked is None:
+        return own_start
+    start = min(max(checked, end - int(catchup_hours * 3600)), own_start)
+    if start < own_start:
+        logger.info('Catching up %s minutes of %s', (own_start - start) // 60, table)
+    return start
+
+
+def mark_checked(table, end, uri=RESULTS_URI):
+    # a run of an earlier interval (e.g. a cleared one) does not move the mark back
+    checked = last_checked(table, uri)
+    if checked is not None and checked >= end:
+        return
+    filesystem, path = mark_path(table, uri)
+    filesystem.create_dir(os.path.dirname(path), recursive=True)
+    # writing through a temporary file so a concurrent run never reads a partial mark
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with filesystem.open_output_stream(tmp_path) as sink:
+        sink.write(str(end).encode())
+    filesystem.move(tmp_path, path)
@@ -0,0 +1,105 @@
+import io
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from anomaly_detection.instrumentation import record_query, timed
+
+logger = logging.getLogger(__name__)
+
+# number of queries sent to ClickHouse at the same time
+MAX_CONCURRENT_QUERIES = int(os.environ.get('ANOMALY_DETECTION_MAX_CONCURRENT_QUERIES', 4))
+# seconds a single query may take, both on the server and on the client side
+QUERY_TIMEOUT = int(os.environ.get('ANOMALY_DETECTION_QUERY_TIMEOUT', 300))
+
+
+class ClickHouseError(Exception):
+    pass
+
+
+def connection_from_env(database=None):
+    # the connection of the command line tools, the DAG passes its own one
+    return {'host': os.environ['CLICKHOUSE_HOST'],
+            'user': os.environ.get('CLICKHOUSE_USER', 'default'),
+            'password': os.environ.get('CLICKHOUSE_PASSWORD', ''),
+            'database': database or os.environ.get('CLICKHOUSE_DATABASE', 'default')}
+
+
+class ClickHouseClient:
+    # the client keeps one keep-alive HTTP session with a connection
+    # pool sized by the concurrency limit, so the queries of a run
+    # reuse connections instead of opening a new one each
+    def __init__(self, connection, max_concurrent_queries=MAX_CONCURRENT_QUERIES, timeout=QUERY_TIMEOUT):
+        self.connection = connection
+        self.max_concurrent_queries = max_concurrent_queries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_queries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'X-ClickHouse-User': connection.get('user', 'default'),
+                                     'X-ClickHouse-Key': connection.get('password', '')})
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, query, timeout=None, params=None):
+        # `params` are the values of the {name:Type} query parameters
+        timeout = timeout or self.timeout
+        # the id finds the query in system.query_log
+        query_id = str(uuid.uuid4())
+        # the summary header only has the final counters when the server
+        # sends the response once the query has finished
+        http_params = {'database': self.connection.get('database', 'default'),
+                       'max_execution_time': timeout,
+                       'query_id': query_id,
+                       'wait_end_of_query': 1}
+        http_params.update({f'param_{name}': value for name, value in (params or {}).items()})
+        started = time.perf_counter()
+        response = self.session.post(self.connection['host'],
+                                     params=http_params,
+                                     data=query.encode(),
+                                     timeout=timeout + 10)
+        if response.status_code != 200:
+            raise ClickHouseError(response.text.strip())
+        # the rows and bytes the server has read are in the summary header
+        record_query(query_id, query, time.perf_counter() - started, response.headers.get('X-ClickHouse-Summary'))
+        return response
+
+    def read(self, query, params=None):
+        response = self.execute(f'{query.strip().rstrip(";")}\nFORMAT TSVWithNames', params=params)
+        if not response.content:
+            return pd.DataFrame()
+        # NULL is written as \N, e.g. by a ratio whose denominator is 0
+        with timed('parse'):
+            return pd.read_csv(io.BytesIO(response.content), sep='\t', na_values=['\\N'])
+
+    def read_many(self, queries, params=None, query_params=None):
+        # running the named queries concurrently, a failed query is reported
+        # by its name and does not prevent the others from being read; all of
+        # them get the same `params`, together with their own ones in `query_params` by name
+        results, errors = {}, {}
+        query_params = query_params or {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_queries) as executor:
+            futures = {name: executor.submit(self.read, query, {**(params or {}), **query_params.get(name, {})})
+                       for name, query in queries.items()}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as error:
+                    logger.error('Query %s failed: %s', name, error)
+                    errors[name] = error
+        return results, errors
@@ -0,0 +1,161 @@
+import logging
+import os
+
+import pandas as pd
+
+from anomaly_detection.baseline import BASELINE_KEY, CACHE_DIR, build_baselines, load_baseline
+from anomaly_detection.clickhouse import ClickHouseError
+from anomaly_detection.metrics import METRICS, METRICS_BY_NAME, SLICE_DIMENSIONS, metric_detector, metrics_by_table
+from anomaly_detection.queries import CURRENT_DAY_QUERY, checked_window, current_queries
+from anomaly_detection.rollup import fresh_rollups
+
+logger = logging.getLogger(__name__)
+
+# `sql` calculates the baseline by the baseline queries, `history` detects the
+# anomalies with anomaly_detection.engine from the per-day history cached on
+# the worker (needs pyarrow)
+BASELINE_SOURCE = os.environ.get('ANOMALY_DETECTION_BASELINE_SOURCE', 'sql')
+
+# `error` is only set for the metrics whose query failed, their other columns are empty;
+# `dimension`, `slice` and `contribution` are only set for the anomalies of the slices;
+# `date` tells apart the intervals of the days a catch-up checks
+RESULT_COLUMNS = ['metric_name', 'resolution', 'date', 'time', 'relative_deviation', 'lower_bound', 'upper_bound',
+                  'avg_relative_deviation', 'avg_expected_value', 'metric_value', 'change',
+                  'dimension', 'slice', 'contribution', 'error']
+
+
+def format_value(metric_name, value):
+    precision = METRICS_BY_NAME[metric_name].precision
+    if pd.isna(value):
+        return str(value)
+    if precision == 0:
+        return str(int(round(value)))
+    return str(round(value, precision))
+
+
+def format_results(df, only_anomalies=True):
+    # turning the calculated values (metric_name, resolution, date, time, value, relative_deviation,
+    # lower_bound, upper_bound, avg_relative_deviation, expected_value, anomaly)
+    # into the reported result
+    if only_anomalies:
+        df = df[df.anomaly]
+    if df.empty:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+
+    df = df.copy()
+    df['change'] = ((df.value * 100) / df.expected_value - 100).round(2).astype(str)
+    df['avg_expected_value'] = [format_value(metric_name, value)
+                                for metric_name, value in zip(df.metric_name, df.expected_value)]
+    df['metric_value'] = [format_value(metric_name, value)
+                          for metric_name, value in zip(df.metric_name, df.value)]
+    df['error'] = None
+    return df.reindex(columns=RESULT_COLUMNS).reset_index(drop=True)
+
+
+def detect(current, baseline, only_anomalies=True):
+    # comparing the values of the last intervals with the baseline of the same weekday
+    # and the same interval of the same resolution, looked up by the index of the baseline
+    df = current.rename(columns={'time_slot': 'time'}).join(baseline, on=BASELINE_KEY, how='inner')
+
+    df['relative_deviation'] = df.value / df.weighted_avg
+    df['expected_value'] = df.avg_relative_deviation * df.weighted_avg
+    df['anomaly'] = ~df.relative_deviation.between(df.lower_bound, df.upper_bound)
+    return format_results(df, only_anomalies)
+
+
+def failed_metrics(errors):
+    return pd.DataFrame([{'metric_name': metric_name, 'error': str(error)}
+                         for metric_name, error in errors.items()],
+                        columns=RESULT_COLUMNS)
+
+
+def combine_results(results):
+    # joining the results of the metric groups checked by separate tasks
+    results = [df for df in results if df is not None and not df.empty]
+    if not results:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return pd.concat(results, ignore_index=True)
+
+
+def history_metrics(metrics, baseline_source=BASELINE_SOURCE):
+    # the metrics checked against the history cached on the worker, all of them with the
+    # `history` source and the ones of the detectors the baseline queries do not have otherwise
+    if baseline_source == 'history':
+        return list(metrics)
+    return [metric for metric in metrics if metric_detector(metric) != 'sigma']
+
+
+def detect_current(client, current, metrics, rollup_tables=(), baseline_source=BASELINE_SOURCE,
+                   only_anomalies=True, cache_dir=CACHE_DIR):
+    if current.date.nunique() > 1:
+        # a catch-up checks the intervals of several days, each one against the baseline of
+        # its day; the days go in order, so the history cached on the worker only moves forward
+        return combine_results([detect_current(client, day_current, metrics, rollup_tables, baseline_source,
+                                               only_anomalies, cache_dir)
+                                for _, day_current in current.groupby('date')])
+    from_history = history_metrics(metrics, baseline_source)
+    names = {metric.name for metric in from_history}
+    results = []
+    if from_history:
+        from anomaly_detection.history import history_detect
+        results.append(history_detect(client, current[current.metric_name.isin(names)], from_history,
+                                      rollup_tables, only_anomalies, cache_dir))
+    if len(from_history) < len(metrics):
+        # the baseline is the one of all the metrics, the same the warm-up caches
+        sql_current = current[~current.metric_name.isin(names)]
+        results.append(detect(sql_current, load_baseline(client, current.date.min(), metrics, rollup_tables, cache_dir),
+                              only_anomalies))
+    return combine_results(results)
+
+
+def warm_up(client, metrics=METRICS, baseline_source=BASELINE_SOURCE, end=None):
+    # preparing what the runs of the day are checked against before they need it: the
+    # first run after midnight calculates the baseline of all the tables at once, the
+    # later runs find it cached and only look it up; returns the warmed day, the one
+    # of the run ending at `end` (see queries.checked_window)
+    tables = metrics_by_table(metrics)
+    rollup_tables = fresh_rollups(client, tables)
+    day = pd.Timestamp(client.read(CURRENT_DAY_QUERY, checked_window(end)).day[0]).date()
+    from_history = history_metrics(metrics, baseline_source)
+    if from_history:
+        from anomaly_detection.history import warm_history
+        warm_history(client, day, from_history, rollup_tables)
+    if len(from_history) < len(metrics):
+        build_baselines(client, day, metrics, rollup_tables)
+    if SLICE_DIMENSIONS:
+        from anomaly_detection.slices import slice_rollups, update_slices
+        update_slices(client, day, metrics, slice_rollups(rollup_tables))
+    return day.isoformat()
+
+
+def detect_anomalies(client, metrics=METRICS, end=None, start=None, cache_dir=CACHE_DIR):
+    # the tables are queried concurrently, a failed table only marks its
+    # own metrics as failed instead of failing the whole run; the checked intervals
+    # are the ones closed after `start` and by `end` (see queries.checked_window)
+    tables = metrics_by_table(metrics)
+    rollup_tables = fresh_rollups(client, tables)
+    results, errors = client.read_many(current_queries(metrics, rollup_tables), checked_window(end, start))
+    if errors and not results:
+        raise ClickHouseError('All the metric queries failed: ' + '; '.join(f'{table}: {error}'
+                                                                           for table, error in errors.items()))
+
+    current = pd.concat(results.values(), ignore_index=True)
+    if current.empty:
+        anomalies = pd.DataFrame(columns=RESULT_COLUMNS)
+    else:
+        checked_metrics = [metric for table in results for metric in tables[table]]
+        anomalies = detect_current(client, current, checked_metrics, rollup_tables, cache_dir=cache_dir)
+
+    slice_anomalies = None
+    if SLICE_DIMENSIONS:
+        # the slices only explain the anomalies, so the metrics are still
+        # reported when they cannot be checked
+        from anomaly_detection.slices import detect_slices
+        try:
+            slice_anomalies = detect_slices(client, [metric for table in results for metric in tables[table]],
+                                            rollup_tables, cache_dir=cache_dir, end=end, start=start)
+        except Exception as error:
+            logger.error('Slices of %s could not be checked: %s', ', '.join(results), error)
+
+    failures = failed_metrics({metric.name: error for table, error in errors.items() for metric in tables[table]})
+    return combine_results([anomalies, slice_anomalies, failures])
@@ -0,0 +1,130 @@
+import os
+import warnings
+
+import numpy as np
+
+from anomaly_detection.engine import baseline
+from anomaly_detection.metrics import metric_detector
+
+# smoothing factor of the ewma detector, the weight of the last day in the running mean
+# and variance of an interval and of the last week in the level of a weekday
+EWMA_ALPHA = float(os.environ.get('ANOMALY_DETECTION_EWMA_ALPHA', 0.1))
+# smoothing factor of the weekly trend of the levels of the ewma detector, 0 for none
+EWMA_BETA = float(os.environ.get('ANOMALY_DETECTION_EWMA_BETA', 0.05))
+# intervals on each side of an interval the seasonal detector smooths its profile
+# and pools its residuals over
+SEASONAL_WINDOW = int(os.environ.get('ANOMALY_DETECTION_SEASONAL_WINDOW', 2))
+
+# the median absolute deviation of normal values times this is their standard deviation,
+# so `sigma` of a metric means the same for every detector
+MAD_SCALE = 1.4826
+
+# every detector fits the (days x slots x metrics) history the way engine.baseline does and
+# returns the same (lower_bound, upper_bound, avg_relative_deviation, weighted_avg) arrays,
+# the bounds of the relative deviation of every interval and the level of every weekday,
+# so they are all checked by engine.check; they work on all the metrics of a table at once
+
+
+def relative_deviations(values):
+    day_avg = np.nanmean(values, axis=1)
+    return day_avg, values / day_avg[:, None, :]
+
+
+def weekday_medians(day_avg, weekdays):
+    level = np.full((7, day_avg.shape[1]), np.nan)
+    for weekday in range(1, 8):
+        level[weekday - 1] = np.nanmedian(day_avg[weekdays == weekday], axis=0)
+    return level
+
+
+def fit_sigma(values, weekdays, sigmas, half_life_weeks=0):
+    # the mean and the standard deviation, the statistics of the baseline queries
+    return baseline(values, weekdays, sigmas, half_life_weeks)
+
+
+def fit_mad(values, weekdays, sigmas, half_life_weeks=0):
+    # the median and the median absolute deviation of every interval and the median level
+    # of every weekday, so the days of past incidents neither shift nor widen the bounds;
+    # an interval whose past values are mostly equal falls back to their standard deviation
+    day_avg, relative_deviation = relative_deviations(values)
+    center = np.nanmedian(relative_deviation, axis=0)
+    scale = MAD_SCALE * np.nanmedian(np.abs(relative_deviation - center), axis=0)
+    scale = np.where(scale > 0, scale, np.nanstd(relative_deviation, axis=0, ddof=1))
+    return center - sigmas * scale, center + sigmas * scale, center, weekday_medians(day_avg, weekdays)
+
+
+def fit_ewma(values, weekdays, sigmas, half_life_weeks=0, alpha=EWMA_ALPHA, beta=EWMA_BETA):
+    # the exponentially weighted mean and variance of every interval over the days, and
+    # Holt's level and trend of the day averages of every weekday over the weeks, so an
+    # incident fades out of the bounds and a growing metric is expected to keep growing;
+    # the days are folded in order, all the intervals and metrics of a day at once
+    day_avg, relative_deviation = relative_deviations(values)
+    mean = np.full(values.shape[1:], np.nan)
+    variance = np.zeros(values.shape[1:])
+    for deviation in relative_deviation:
+        present = ~np.isnan(deviation)
+        first = present & np.isnan(mean)
+        difference = deviation - mean
+        variance = np.where(first, 0, np.where(present, (1 - alpha) * (variance + alpha * difference ** 2), variance))
+        mean = np.where(first, deviation, np.where(present, mean + alpha * difference, mean))
+
+    level = np.full((7, values.shape[2]), np.nan)
+    trend = np.zeros((7, values.shape[2]))
+    for average, weekday in zip(day_avg, weekdays):
+        i = weekday - 1
+        present = ~np.isnan(average)
+        first = present & np.isnan(level[i])
+        smoothed = alpha * average + (1 - alpha) * (level[i] + trend[i])
+        trend[i] = np.where(first, 0, np.where(present, beta * (smoothed - level[i]) + (1 - beta) * trend[i], trend[i]))
+        level[i] = np.where(first, average, np.where(present, smoothed, level[i]))
+
+    scale = np.sqrt(variance)
+    # a single past value has no spread, like the standard deviation of one value
+    scale[np.sum(~np.isnan(relative_deviation), axis=0) < 2] = np.nan
+    return mean - sigmas * scale, mean + sigmas * scale, mean, level + trend
+
+
+def circular_window(array, window):
+    # the values of the `window` intervals on each side of every interval, the
+    # intervals of a day wrap around the midnight; the window is the first axis
+    return np.stack([np.roll(array, shift, axis=-2) for shift in range(-window, window + 1)])
+
+
+def fit_seasonal(values, weekdays, sigmas, half_life_weeks=0, window=SEASONAL_WINDOW):
+    # a decomposition of the relative deviations into a daily profile, the medians of the
+    # intervals smoothed over the neighbouring ones, and the residuals of the days around
+    # it, whose robust scale is pooled over the neighbouring intervals as well, so every
+    # band is estimated from (2 * window + 1) times more values; the level is the median one
+    day_avg, relative_deviation = relative_deviations(values)
+    profile = np.nanmean(circular_window(np.nanmedian(relative_deviation, axis=0), window), axis=0)
+    residuals = np.abs(relative_deviation - profile)
+    scale = MAD_SCALE * np.nanmedian(circular_window(residuals, window), axis=(0, 1))
+    return profile - sigmas * scale, profile + sigmas * scale, profile, weekday_medians(day_avg, weekdays)
+
+
+FIT = {'sigma': fit_sigma, 'mad': fit_mad, 'ewma': fit_ewma, 'seasonal': fit_seasonal}
+
+
+def detector_settings():
+    # the settings the fitted bounds depend on besides the metrics and the history
+    return EWMA_ALPHA, EWMA_BETA, SEASONAL_WINDOW
+
+
+def fit(values, weekdays, metrics, half_life_weeks=0):
+    # the bounds of the metrics of a table, every group of metrics sharing
+    # a detector is fitted by one call over its columns of the history
+    sigmas = np.array([metric.sigma for metric in metrics], dtype=float)
+    bounds = [np.full(values.shape[1:], np.nan) for _ in range(3)] + [np.full((7, values.shape[2]), np.nan)]
+    groups = {}
+    for i, metric in enumerate(metrics):
+        groups.setdefault(metric_detector(metric), []).append(i)
+
+    with warnings.catch_warnings():
+        # days and intervals without any value produce NaN, as in ClickHouse
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for detector, columns in groups.items():
+            # the history of a table checked by one detector is fitted as it is
+            group_values = values if len(columns) == values.shape[2] else values[:, :, columns]
+            for array, fitted in zip(bounds, FIT[detector](group_values, weekdays, sigmas[columns], half_life_weeks)):
+                array[:, columns] = fitted
+    return tuple(bounds)
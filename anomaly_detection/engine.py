@@ -0,0 +1,187 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# minutes in a day, which has DAY_MINUTES // resolution intervals of a resolution
+DAY_MINUTES = 24 * 60
+
+
+def slot_times(slots):
+    # the '%H:%M:%S' keys the queries use for the intervals of a day
+    minutes = np.arange(slots) * (DAY_MINUTES // slots)
+    return [f'{minute // 60:02d}:{minute % 60:02d}:00' for minute in minutes]
+
+
+def slot_indexes(times, slots):
+    # the positions of the '%H:%M:%S' keys among the intervals of a day
+    times = pd.Series(times, dtype=str)
+    minutes = times.str.slice(0, 2).astype(int) * 60 + times.str.slice(3, 5).astype(int)
+    return (minutes // (DAY_MINUTES // slots)).to_numpy()
+
+
+def date_weights(mask, half_life_weeks=0):
+    # the weights of the present days of a weekday (`mask`, days x metrics): the n-th
+    # day has the weight n like ROW_NUMBER() does in the queries, or the weight halves
+    # every `half_life_weeks` weeks before the last day
+    if half_life_weeks:
+        ages = np.arange(len(mask), 0, -1)
+        return np.exp2(-ages / (7 * half_life_weeks))[:, None] * mask
+    return np.cumsum(mask, axis=0) * mask
+
+
+def baseline(values, weekdays, sigmas, half_life_weeks=0):
+    # `values` is a (days x slots x metrics) array of consecutive days ending the day
+    # before the checked one, with NaN for the intervals without events, `weekdays`
+    # holds the ISO weekday of every day; the statistics are the same as the ones of
+    # the baseline queries
+    with warnings.catch_warnings():
+        # days and intervals without any value produce NaN, as in ClickHouse
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        # average metric value throughout a day and the relative deviations from it
+        day_avg = np.nanmean(values, axis=1)
+        relative_deviation = values / day_avg[:, None, :]
+
+        # confidence interval of the relative deviations for each interval
+        avg_relative_deviation = np.nanmean(relative_deviation, axis=0)
+        std_relative_deviation = np.nanstd(relative_deviation, axis=0, ddof=1)
+        lower_bound = avg_relative_deviation - sigmas * std_relative_deviation
+        upper_bound = avg_relative_deviation + sigmas * std_relative_deviation
+
+        # weighted average of the day averages for every weekday
+        present = ~np.isnan(day_avg)
+        weighted_avg = np.full((7, values.shape[2]), np.nan)
+        for weekday in range(1, 8):
+            weights = date_weights((weekdays == weekday)[:, None] & present, half_life_weeks)
+            weighted_avg[weekday - 1] = np.nansum(day_avg * weights, axis=0) / weights.sum(axis=0)
+
+    return lower_bound, upper_bound, avg_relative_deviation, weighted_avg
+
+
+def detect(values, weekdays, sigmas, current, slots, current_weekdays, half_life_weeks=0):
+    # checking a batch of intervals at once: `current` is an (intervals x metrics)
+    # array of the checked values, `slots` and `current_weekdays` hold the interval
+    # of the day and the ISO weekday of every checked row
+    return check(baseline(values, weekdays, sigmas, half_life_weeks), current, slots, current_weekdays)
+
+
+def check(bounds, current, slots, current_weekdays):
+    # checking the intervals against `bounds`, the (lower_bound, upper_bound,
+    # avg_relative_deviation, weighted_avg) of baseline or of a detector of anomaly_detection.detectors
+    lower_bound, upper_bound, avg_relative_deviation, weighted_avg = bounds
+
+    weighted_avg = weighted_avg[current_weekdays - 1]
+    lower_bound = lower_bound[slots]
+    upper_bound = upper_bound[slots]
+    avg_relative_deviation = avg_relative_deviation[slots]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_deviation = current / weighted_avg
+        expected_value = avg_relative_deviation * weighted_avg
+    # an interval is only checked when it has a value and a baseline,
+    # the NaN bounds of a single past value flag it like NOT BETWEEN does
+    checked = ~np.isnan(current) & ~np.isnan(weighted_avg) & ~np.isnan(avg_relative_deviation)
+    anomaly = checked & ~((relative_deviation >= lower_bound) & (relative_deviation <= upper_bound))
+
+    return {'relative_deviation': relative_deviation,
+            'lower_bound': lower_bound,
+            'upper_bound': upper_bound,
+            'avg_relative_deviation': avg_relative_deviation,
+            'expected_value': expected_value,
+            'checked': checked,
+            'anomaly': anomaly}
+
+
+def baseline_frame(values, weekdays, metrics, half_life_weeks=0):
+    # the baseline in the layout of the baseline queries, one row per metric,
+    # weekday and interval which had events at least once
+    lower_bound, upper_bound, avg_relative_deviation, weighted_avg = \
+        baseline(values, weekdays, np.array([metric.sigma for metric in metrics], dtype=float), half_life_weeks)
+
+    slots, weekday_count = values.shape[1], weighted_avg.shape[0]
+    times = np.array(slot_times(slots))
+    frames = []
+    for i, metric in enumerate(metrics):
+        frames.append(pd.DataFrame({
+            'metric_name': metric.name,
+            'resolution': DAY_MINUTES // slots,
+            'weekday': np.repeat(np.arange(1, weekday_count + 1), slots),
+            'time': np.tile(times, weekday_count),
+            'lower_bound': np.tile(lower_bound[:, i], weekday_count),
+            'upper_bound': np.tile(upper_bound[:, i], weekday_count),
+            'avg_relative_deviation': np.tile(avg_relative_deviation[:, i], weekday_count),
+            'weighted_avg': np.repeat(weighted_avg[:, i], slots),
+        }))
+    df = pd.concat(frames, ignore_index=True)
+    return df[df.avg_relative_deviation.notna() & df.weighted_avg.notna()].reset_index(drop=True)
+
+
+def window_sums(x, lookback=None):
+    # the sums of the `lookback` rows before every row, of all of them when it is not set
+    prefix = np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(x, axis=0)])
+    end = np.arange(len(x))
+    start = np.maximum(end - lookback, 0) if lookback else np.zeros_like(end)
+    return prefix[end] - prefix[start], prefix[start]
+
+
+def as_of_statistics(values, weekdays, lookback=None, half_life_weeks=0):
+    # the statistics every day would have been checked with, calculated only from
+    # the `lookback` days before it with running sums, so the whole history is
+    # replayed in one pass: the mean and the sample standard deviation of the
+    # relative deviations of every interval and the weighted average of the day weekday
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        day_avg = np.nanmean(values, axis=1)
+        relative_deviation = values / day_avg[:, None, :]
+
+        present = ~np.isnan(relative_deviation)
+        deviations = np.where(present, relative_deviation, 0)
+        count, _ = window_sums(present, lookback)
+        total, _ = window_sums(deviations, lookback)
+        squares, _ = window_sums(deviations ** 2, lookback)
+
+        mean = total / count
+        std = np.sqrt(np.maximum(squares - total ** 2 / count, 0) / (count - 1))
+        mean[count == 0] = np.nan
+        std[count < 2] = np.nan
+
+        weighted_avg = np.full(day_avg.shape, np.nan)
+        day_present = ~np.isnan(day_avg)
+        for weekday in range(1, 8):
+            days = weekdays == weekday
+            mask = days[:, None] & day_present
+            averages = np.where(mask, day_avg, 0)
+            if half_life_weeks:
+                # the weights relative to the last day, their scale cancels out
+                weights = date_weights(mask, half_life_weeks)
+                numerator, _ = window_sums(averages * weights, lookback)
+                denominator, _ = window_sums(weights, lookback)
+            else:
+                # the ranks among all the days, shifted by the number of the
+                # days which precede the window to start at 1 inside of it
+                ranks = date_weights(mask)
+                ranked, _ = window_sums(averages * ranks, lookback)
+                summed, _ = window_sums(averages, lookback)
+                rank_sum, _ = window_sums(ranks, lookback)
+                present_days, preceding = window_sums(mask, lookback)
+                numerator = ranked - preceding * summed
+                denominator = rank_sum - preceding * present_days
+            weighted_avg[days] = (numerator / denominator)[days]
+
+    return mean, std, weighted_avg
+
+
+def replay(values, weekdays, sigmas, lookback=None, half_life_weeks=0):
+    # checking every interval of every day against the baseline of the `lookback`
+    # days before it, the result arrays have the (days x slots x metrics) shape
+    mean, std, weighted_avg = as_of_statistics(values, weekdays, lookback, half_life_weeks)
+    lower_bound = mean - sigmas * std
+    upper_bound = mean + sigmas * std
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_deviation = values / weighted_avg[:, None, :]
+    checked = ~np.isnan(values) & ~np.isnan(weighted_avg)[:, None, :] & ~np.isnan(mean)
+    anomaly = checked & ~((relative_deviation >= lower_bound) & (relative_deviation <= upper_bound))
+    return checked, anomaly
@@ -0,0 +1,299 @@
+import logging
+import os
+import shutil
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from anomaly_detection.baseline import BASELINE_TTL_HOURS, CACHE_DIR, is_fresh
+from anomaly_detection.clickhouse import ClickHouseError
+from anomaly_detection.detectors import detector_settings, fit
+from anomaly_detection.engine import DAY_MINUTES, baseline_frame, check, slot_indexes
+from anomaly_detection.metrics import (METRICS, RESOLUTIONS, check_resolutions, definition_hash, metric_detector,
+                                       metrics_by_table)
+from anomaly_detection.queries import HALF_LIFE_WEEKS, LOOKBACK_WEEKS, render_query, table_rollup
+
+logger = logging.getLogger(__name__)
+
+# number of days before the checked one kept in the history, the lookback window of the baseline
+HISTORY_DAYS = 7 * LOOKBACK_WEEKS
+# size the history of a table may take on disk, the oldest days are evicted first
+HISTORY_MAX_BYTES = int(os.environ.get('ANOMALY_DETECTION_HISTORY_MAX_BYTES', 512 * 2 ** 20))
+
+# the arrays of the bounds fitted by anomaly_detection.detectors, as they are cached
+FITTED_ARRAYS = ('lower_bound', 'upper_bound', 'avg_relative_deviation', 'weighted_avg')
+
+# the history keeps the metric values of every interval of every resolution of the past
+# days, one Arrow IPC file per table and day, which is fetched again like an expired baseline
+# until it has been fetched BASELINE_TTL_HOURS after the end of its day, so it takes in
+# the events which have arrived late, and never changes after that
+HISTORY_QUERY = """
+        SELECT toDate(interval_start) AS date,
+                resolution,
+                intDiv(toHour(interval_start) * 60 + toMinute(interval_start), resolution) AS slot,
+                {aggregates}
+        FROM {table}
+        {intervals}
+        WHERE time >= toDateTime({{first_day:Date}}) AND time < toDateTime({{last_day:Date}} + 1)
+            AND has({{days:Array(Date)}}, toDate(time))
+        GROUP BY resolution, interval_start
+        """
+
+
+def history_dir(table, table_metrics, cache_dir=CACHE_DIR, kind='history', definition=()):
+    # the directory changes whenever the metrics of the table are redefined
+    return os.path.join(cache_dir, kind, table, definition_hash(table_metrics, extra=definition))
+
+
+def day_path(directory, day):
+    return os.path.join(directory, f'{day.isoformat()}.arrow')
+
+
+def history_schema(table_metrics):
+    return pa.schema([('resolution', pa.uint16()), ('slot', pa.uint16())]
+                     + [(metric.column, pa.float64()) for metric in table_metrics])
+
+
+def write_day(path, df, schema):
+    table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    # writing through a temporary file so a concurrent run never maps a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def read_day(path):
+    # the files are not compressed, so the columns are read straight from the
+    # mapped pages, which stay mapped as long as the returned table is used
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def is_cached(path, past_day, ttl_hours=BASELINE_TTL_HOURS):
+    if not os.path.exists(path):
+        return False
+    day_end = datetime.combine(past_day + timedelta(days=1), datetime.min.time()).timestamp()
+    return os.path.getmtime(path) >= day_end + ttl_hours * 3600 or is_fresh(path, ttl_hours)
+
+
+def history_mtime(directory, window):
+    # when the cached days of the window were fetched last
+    return max((os.path.getmtime(day_path(directory, past_day)) for past_day in window
+                if os.path.exists(day_path(directory, past_day))), default=0)
+
+
+def history_days(day, days=HISTORY_DAYS):
+    return [day - timedelta(days=offset) for offset in range(days, 0, -1)]
+
+
+def history_params(days):
+    # the parameters of the history queries fetching `days`, an array is sent as its literal
+    return {'first_day': days[0].isoformat(),
+            'last_day': days[-1].isoformat(),
+            'days': '[' + ', '.join(f"'{past_day.isoformat()}'" for past_day in days) + ']'}
+
+
+def horizon_path(directory):
+    return os.path.join(directory, 'horizon')
+
+
+def read_horizon(directory):
+    # the last day evicted to fit the size limit, the older days are not fetched again
+    if not os.path.exists(horizon_path(directory)):
+        return None
+    with open(horizon_path(directory)) as file:
+        return date.fromisoformat(file.read().strip())
+
+
+def evict(directory, window, max_bytes=HISTORY_MAX_BYTES):
+    # removing the days which left the history window, the other definitions of the table
+    # (e.g. of another deployment or of the metrics before a change) which have not been
+    # used for as many days as the window has, so none of their days is needed anymore,
+    # then the least recently used definitions and the oldest days until the table fits into `max_bytes`
+    os.utime(directory)
+    keep = {os.path.basename(day_path(directory, past_day)) for past_day in window}
+    files = []
+    for file_name in os.listdir(directory):
+        path = os.path.join(directory, file_name)
+        if file_name in keep:
+            files.append((file_name, os.path.getsize(path), path))
+        elif file_name.endswith('.arrow'):
+            os.remove(path)
+
+    table_dir = os.path.dirname(directory)
+    definitions = []
+    for definition in os.listdir(table_dir):
+        path = os.path.join(table_dir, definition)
+        if path == directory:
+            continue
+        if time.time() - os.path.getmtime(path) > len(window) * 86400:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            definitions.append((os.path.getmtime(path), sum(os.path.getsize(os.path.join(path, file_name))
+                                                            for file_name in os.listdir(path)), path))
+
+    size = sum(file_size for _, file_size, _ in files) + sum(dir_size for _, dir_size, _ in definitions)
+    for _, dir_size, path in sorted(definitions):
+        if size <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        size -= dir_size
+    for file_name, file_size, path in sorted(files):
+        if size <= max_bytes:
+            break
+        os.remove(path)
+        size -= file_size
+        with open(horizon_path(directory), 'w') as file:
+            file.write(file_name[:-len('.arrow')])
+
+
+def update_history(client, day, metrics=METRICS, rollup_tables=(), cache_dir=CACHE_DIR, days=HISTORY_DAYS,
+                   query=HISTORY_QUERY, kind='history', schema=history_schema, definition=(),
+                   ttl_hours=BASELINE_TTL_HOURS, **params):
+    # only the days missing from the cache or expired are fetched, in one query per table;
+    # `query`, `kind`, `schema` and `definition` describe the other histories kept the same way
+    tables = metrics_by_table(metrics)
+    window = history_days(day, days)
+    directories = {table: history_dir(table, table_metrics, cache_dir, kind, definition)
+                   for table, table_metrics in tables.items()}
+
+    queries, query_params, missing = {}, {}, {}
+    for table, table_metrics in tables.items():
+        os.makedirs(directories[table], exist_ok=True)
+        horizon = read_horizon(directories[table])
+        missing[table] = [past_day for past_day in window
+                          if (horizon is None or past_day > horizon)
+                          and not is_cached(day_path(directories[table], past_day), past_day, ttl_hours)]
+        if missing[table]:
+            queries[table] = render_query(query, table, table_metrics,
+                                          rollup=table_rollup(table, table_metrics, rollup_tables),
+                                          baseline=True,
+                                          resolutions=RESOLUTIONS,
+                                          **params)
+            query_params[table] = history_params(missing[table])
+
+    results, errors = client.read_many(queries, query_params=query_params)
+    for table, df in results.items():
+        days_values = {pd.Timestamp(value_date).date(): day_df for value_date, day_df in df.groupby('date')} if not df.empty else {}
+        for past_day in missing[table]:
+            # the days without events are stored empty, so they are not fetched again
+            day_df = days_values.get(past_day, pd.DataFrame(columns=df.columns))
+            write_day(day_path(directories[table], past_day), day_df, schema(tables[table]))
+        logger.info('Fetched %s days of %s %s', len(missing[table]), table, kind)
+
+    # the day itself is kept as well, a catch-up checks the previous day after the warm-up of the day
+    for directory in directories.values():
+        evict(directory, window + [day])
+    if errors:
+        raise ClickHouseError(f'{kind.capitalize()} queries failed for ' + ', '.join(errors))
+
+
+def load_history(day, table_metrics, resolution, cache_dir=CACHE_DIR, days=HISTORY_DAYS):
+    # the intervals of `resolution` of the `days` days before `day` as a (days x slots
+    # x metrics) array together with the ISO weekday of every day, the days missing
+    # from the cache are left NaN, so they count like the days without events
+    directory = history_dir(table_metrics[0].table, table_metrics, cache_dir)
+    window = history_days(day, days)
+
+    values = np.full((len(window), DAY_MINUTES // resolution, len(table_metrics)), np.nan)
+    for i, past_day in enumerate(window):
+        if not os.path.exists(day_path(directory, past_day)):
+            continue
+        table = read_day(day_path(directory, past_day))
+        rows = table.column('resolution').to_numpy() == resolution
+        slots = table.column('slot').to_numpy()[rows]
+        for j, metric in enumerate(table_metrics):
+            values[i, slots, j] = table.column(metric.column).to_numpy()[rows]
+    weekdays = np.array([past_day.isoweekday() for past_day in window])
+    return values, weekdays
+
+
+def fitted_path(day, table_metrics, resolution, cache_dir=CACHE_DIR, days=HISTORY_DAYS):
+    definition = definition_hash(table_metrics, extra=(resolution, days, HALF_LIFE_WEEKS, detector_settings(),
+                                                       [metric_detector(metric) for metric in table_metrics]))
+    return os.path.join(cache_dir, 'fitted', table_metrics[0].table, f'{day.isoformat()}-{definition}.npz')
+
+
+def load_fitted(day, table_metrics, resolution, cache_dir=CACHE_DIR, days=HISTORY_DAYS):
+    # the bounds the detectors of the metrics have fitted to the history of the `days` days
+    # before `day`; they only change with the day and with the days fetched again, so they are
+    # fitted by the first run after them and the later runs read them instead of the whole history
+    path = fitted_path(day, table_metrics, resolution, cache_dir, days)
+    directory = history_dir(table_metrics[0].table, table_metrics, cache_dir)
+    if os.path.exists(path) and os.path.getmtime(path) >= history_mtime(directory, history_days(day, days)):
+        with np.load(path) as fitted:
+            return tuple(fitted[name] for name in FITTED_ARRAYS)
+
+    values, weekdays = load_history(day, table_metrics, resolution, cache_dir, days)
+    bounds = fit(values, weekdays, table_metrics, HALF_LIFE_WEEKS)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # writing through a temporary file so a concurrent run never reads partial bounds
+    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **dict(zip(FITTED_ARRAYS, bounds)))
+    os.replace(tmp_path, path)
+    # the bounds of the days before the previous one are not needed anymore (see baseline.save_baseline)
+    previous_day = (day - timedelta(days=1)).isoformat()
+    for file_name in os.listdir(os.path.dirname(path)):
+        if file_name.endswith('.npz') and file_name[:10] < previous_day:
+            os.remove(os.path.join(os.path.dirname(path), file_name))
+    return bounds
+
+
+def history_baseline(client, day, metrics=METRICS, rollup_tables=(), cache_dir=CACHE_DIR):
+    # the baseline recalculated from the cached history instead of the baseline queries
+    update_history(client, day, metrics, rollup_tables, cache_dir)
+    frames = []
+    for table_metrics in metrics_by_table(metrics).values():
+        for resolution in check_resolutions(RESOLUTIONS):
+            values, weekdays = load_history(day, table_metrics, resolution, cache_dir)
+            frames.append(baseline_frame(values, weekdays, table_metrics, HALF_LIFE_WEEKS))
+    return pd.concat(frames, ignore_index=True)
+
+
+def warm_history(client, day, metrics=METRICS, rollup_tables=(), cache_dir=CACHE_DIR):
+    # fetching the missing days of the history and fitting the bounds of the day
+    update_history(client, day, metrics, rollup_tables, cache_dir)
+    for table_metrics in metrics_by_table(metrics).values():
+        for resolution in check_resolutions(RESOLUTIONS):
+            load_fitted(day, table_metrics, resolution, cache_dir)
+
+
+def history_detect(client, current, metrics=METRICS, rollup_tables=(), only_anomalies=True, cache_dir=CACHE_DIR):
+    # checking the current values of all the metrics of a table in one batch
+    # of NumPy operations against the bounds their detectors have fitted to the
+    # cached history of the table
+    from anomaly_detection.detection import RESULT_COLUMNS, format_results
+
+    day = pd.Timestamp(current.date.min()).date()
+    update_history(client, day, metrics, rollup_tables, cache_dir)
+
+    frames = []
+    for table_metrics in metrics_by_table(metrics).values():
+        names = [metric.name for metric in table_metrics]
+        table_current = current[current.metric_name.isin(names)]
+        for resolution, resolution_current in table_current.groupby('resolution'):
+            resolution_current = resolution_current \
+                .pivot_table(index=['weekday', 'time_slot'], columns='metric_name', values='value') \
+                .reindex(columns=names)
+
+            times = resolution_current.index.get_level_values('time_slot')
+            result = check(load_fitted(day, table_metrics, resolution, cache_dir),
+                           resolution_current.to_numpy(dtype=float),
+                           slot_indexes(times, DAY_MINUTES // resolution),
+                           resolution_current.index.get_level_values('weekday').to_numpy())
+
+            intervals, metric_count = resolution_current.shape
+            df = pd.DataFrame({name: column.ravel() for name, column in result.items()})
+            df['metric_name'] = np.tile(names, intervals)
+            df['resolution'] = resolution
+            df['date'] = day.isoformat()
+            df['time'] = np.repeat(times.to_numpy(), metric_count)
+            df['value'] = resolution_current.to_numpy(dtype=float).ravel()
+            frames.append(df[df.checked])
+
+    if not frames:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return format_results(pd.concat(frames, ignore_index=True), only_anomalies)
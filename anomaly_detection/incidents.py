@@ -0,0 +1,109 @@
+import json
+import math
+import os
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs
+
+from anomaly_detection.metrics import SCHEDULE_MINUTES
+from anomaly_detection.results import RESULTS_URI, filesystem_from_uri
+
+# an open incident is reported again once its deviation has grown this many times
+# since it was last reported
+ESCALATION_FACTOR = float(os.environ.get('ANOMALY_DETECTION_ESCALATION_FACTOR', 1.5))
+
+# the incidents which are still open between the runs are kept by their key in a JSON
+# file next to the results, like the catch-up marks (see anomaly_detection.catchup),
+# so the report tasks find them on whichever worker they run
+
+
+def text_or_none(value):
+    # the slice columns of the metric results are NaN
+    return value if isinstance(value, str) else None
+
+
+def incident_key(metric_name, resolution, dimension, slice):
+    # an incident is an anomaly of a metric at a resolution, in the whole table or in one slice
+    return '|'.join([metric_name, str(int(resolution)), text_or_none(dimension) or '', text_or_none(slice) or ''])
+
+
+def quiet_runs_to_resolve(resolution, schedule_minutes=SCHEDULE_MINUTES):
+    # the number of runs without the anomaly after which the next interval
+    # of the resolution has been checked and found normal
+    return max(1, math.ceil(resolution / schedule_minutes))
+
+
+def absolute_change(change):
+    change = float(change)
+    return 0 if math.isnan(change) else abs(change)
+
+
+def incidents_path(uri=RESULTS_URI):
+    filesystem, directory = filesystem_from_uri(uri)
+    return filesystem, f'{directory}/incidents/open.json'
+
+
+def load_incidents(uri=RESULTS_URI):
+    filesystem, path = incidents_path(uri)
+    if filesystem.get_file_info(path).type != pa.fs.FileType.File:
+        return {}
+    with filesystem.open_input_stream(path) as source:
+        return json.loads(source.read().decode())
+
+
+def save_incidents(incidents, uri=RESULTS_URI):
+    filesystem, path = incidents_path(uri)
+    filesystem.create_dir(os.path.dirname(path), recursive=True)
+    # writing through a temporary file so a concurrent run never reads partial incidents
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with filesystem.open_output_stream(tmp_path) as sink:
+        sink.write(json.dumps(incidents).encode())
+    filesystem.move(tmp_path, path)
+
+
+def track(df, incidents, escalation_factor=ESCALATION_FACTOR, schedule_minutes=SCHEDULE_MINUTES):
+    # updating the open `incidents` (see load_incidents) with the results of a run; only the
+    # anomalies which open an incident or escalate it are returned for the report, with their
+    # `state`, together with the metric incidents which have been resolved by the run and the
+    # incidents which are open after it
+    failed = df[df.error.notna()]
+    anomalies = df[df.error.isna()].copy()
+    keys = [incident_key(*key) for key in zip(anomalies.metric_name, anomalies.resolution,
+                                              anomalies.dimension, anomalies.slice)]
+    seen = set(keys)
+    incidents = {key: dict(incident) for key, incident in incidents.items()}
+
+    states = []
+    for key, row in zip(keys, anomalies.itertuples(index=False)):
+        change = absolute_change(row.change)
+        if key not in incidents:
+            states.append('opened')
+            # the later intervals of the same run only escalate it
+            incidents[key] = {'metric_name': row.metric_name, 'resolution': int(row.resolution),
+                              'dimension': text_or_none(row.dimension), 'slice': text_or_none(row.slice),
+                              'started': f'{row.date} {row.time[:5]}', 'reported_change': change,
+                              'quiet_runs': 0}
+        elif change >= escalation_factor * incidents[key]['reported_change'] and change > 0:
+            states.append('escalated')
+            incidents[key].update(reported_change=change, quiet_runs=0)
+        else:
+            states.append(None)
+            incidents[key]['quiet_runs'] = 0
+
+    # the incidents of the metrics which could not be checked stay as they are
+    resolved, failed_metrics = [], set(failed.metric_name)
+    for key, incident in list(incidents.items()):
+        if key in seen or incident['metric_name'] in failed_metrics:
+            continue
+        if incident['quiet_runs'] + 1 < quiet_runs_to_resolve(incident['resolution'], schedule_minutes):
+            incident['quiet_runs'] += 1
+            continue
+        del incidents[key]
+        # the end of a slice incident is not worth a message of its own
+        if incident['dimension'] is None:
+            resolved.append({name: incident[name] for name in ('metric_name', 'resolution', 'started')})
+
+    anomalies['state'] = states
+    return pd.concat([anomalies[anomalies.state.notna()], failed], ignore_index=True), resolved, incidents
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# host:port of a StatsD server the timings of every task are sent to
+STATSD_ADDRESS = os.environ.get('ANOMALY_DETECTION_STATSD_ADDRESS')
+STATSD_PREFIX = os.environ.get('ANOMALY_DETECTION_STATSD_PREFIX', 'anomaly_detection')
+# directory of the node_exporter textfile collector the timings are written to as well
+PROMETHEUS_TEXTFILE_DIR = os.environ.get('ANOMALY_DETECTION_PROMETHEUS_TEXTFILE_DIR')
+# `1` to read the peak memory of the queries from system.query_log at the end of a task,
+# which the X-ClickHouse-Summary header does not have
+QUERY_LOG = os.environ.get('ANOMALY_DETECTION_QUERY_LOG', '0') == '1'
+
+# the stage of a query, recognised by the columns of its template
+STAGES = [('slices', 'slice_key'), ('baseline', 'weighted_avg'), ('history', 'AS slot'),
+          ('current', 'AS time_slot'), ('rollups', 'AS fresh')]
+
+QUERY_COUNTERS = ('read_rows', 'read_bytes', 'result_rows', 'result_bytes')
+
+QUERY_LOG_QUERY = """
+    SELECT query_id, memory_usage, read_rows, read_bytes, query_duration_ms
+    FROM system.query_log
+    WHERE type = 'QueryFinish' AND event_date >= today() - 1 AND query_id IN ({query_ids})
+    """
+
+
+def query_stage(query):
+    return next((stage for stage, marker in STAGES if marker in query), 'other')
+
+
+class Stats:
+    # the queries and the stages of the task running in the process, the
+    # queries of a task are sent from several threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.queries = []
+        self.stages = {}
+
+    def add_query(self, query_id, stage, seconds, summary):
+        with self.lock:
+            self.queries.append({'query_id': query_id, 'stage': stage, 'seconds': seconds, 'memory_usage': None,
+                                 **{counter: int(summary.get(counter, 0)) for counter in QUERY_COUNTERS}})
+        self.add_stage(stage, seconds)
+
+    def add_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+
+STATS = Stats()
+
+
+def record_query(query_id, query, seconds, summary_header=None):
+    # `summary_header` is the X-ClickHouse-Summary header of the response
+    STATS.add_query(query_id, query_stage(query), seconds, json.loads(summary_header) if summary_header else {})
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STATS.add_stage(stage, time.perf_counter() - started)
+
+
+def add_query_log(client):
+    # the peak memory of the queries of the task, the log is flushed first so the
+    # last queries are in it; the stats stay without it when the log cannot be read
+    query_ids = [query['query_id'] for query in STATS.queries if query['query_id']]
+    if not query_ids:
+        return
+    # the queries reading the log are not a part of the task
+    queries, stages = list(STATS.queries), dict(STATS.stages)
+    try:
+        try:
+            client.execute('SYSTEM FLUSH LOGS')
+        except Exception as error:
+            logger.warning('Query log could not be flushed: %s', error)
+        df = client.read(QUERY_LOG_QUERY.format(query_ids=', '.join(f"'{query_id}'" for query_id in query_ids)))
+    except Exception as error:
+        logger.warning('Query log could not be read: %s', error)
+        return
+    finally:
+        STATS.queries, STATS.stages = queries, stages
+    # memory_usage is a method of the data frames as well
+    memory = dict(zip(df['query_id'], df['memory_usage'])) if not df.empty else {}
+    for query in STATS.queries:
+        if query['query_id'] in memory:
+            query['memory_usage'] = int(memory[query['query_id']])
+
+
+def task_summary(task, labels, seconds, state):
+    memory = [query['memory_usage'] for query in STATS.queries if query['memory_usage'] is not None]
+    return {'task': task, **labels, 'state': state, 'seconds': round(seconds, 3), 'queries': len(STATS.queries),
+            **{counter: sum(query[counter] for query in STATS.queries) for counter in QUERY_COUNTERS},
+            'memory_usage': max(memory) if memory else None,
+            'stages': {stage: round(stage_seconds, 3) for stage, stage_seconds in STATS.stages.items()}}
+
+
+def metric_name_part(value):
+    return re.sub(r'[^A-Za-z0-9_]', '_', str(value))
+
+
+def statsd_lines(summary, labels, prefix=STATSD_PREFIX):
+    # the labels are a part of the names, plain StatsD has no tags
+    name = '.'.join([prefix, summary['task']] + [metric_name_part(value) for value in labels.values()])
+    lines = [f"{name}.seconds:{summary['seconds'] * 1000:.0f}|ms", f"{name}.{summary['state']}:1|c",
+             f"{name}.queries:{summary['queries']}|c"]
+    lines += [f"{name}.{counter}:{summary[counter]}|c" for counter in QUERY_COUNTERS]
+    lines += [f"{name}.stages.{stage}.seconds:{seconds * 1000:.0f}|ms" for stage, seconds in summary['stages'].items()]
+    if summary['memory_usage'] is not None:
+        lines.append(f"{name}.memory_usage:{summary['memory_usage']}|g")
+    return lines
+
+
+def send_statsd(lines, address=STATSD_ADDRESS):
+    host, port = address.rsplit(':', 1)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as connection:
+        for line in lines:
+            connection.sendto(line.encode(), (host, int(port)))
+
+
+def prometheus_labels(labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def prometheus_text(summary, labels):
+    labels = {'task': summary['task'], **labels}
+    gauges = {'anomaly_detection_task_seconds': summary['seconds'],
+              'anomaly_detection_task_success': int(summary['state'] == 'success'),
+              'anomaly_detection_task_last_run_timestamp_seconds': round(time.time()),
+              'anomaly_detection_task_queries': summary['queries']}
+    gauges.update({f'anomaly_detection_task_{counter}': summary[counter] for counter in QUERY_COUNTERS})
+    if summary['memory_usage'] is not None:
+        gauges['anomaly_detection_task_memory_usage_bytes'] = summary['memory_usage']
+
+    lines = []
+    for name, value in gauges.items():
+        lines += [f'# TYPE {name} gauge', f'{name}{{{prometheus_labels(labels)}}} {value}']
+    lines.append('# TYPE anomaly_detection_stage_seconds gauge')
+    lines += [f'anomaly_detection_stage_seconds{{{prometheus_labels({**labels, "stage": stage})}}} {seconds}'
+              for stage, seconds in summary['stages'].items()]
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(text, name, directory=PROMETHEUS_TEXTFILE_DIR):
+    # the collector may read the file at any time, so it is replaced at once
+    path = os.path.join(directory, f'{name}.prom')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def export(summary, labels):
+    # the metrics of a task are never worth failing it
+    logger.info('Task summary: %s', json.dumps(summary))
+    try:
+        if STATSD_ADDRESS:
+            send_statsd(statsd_lines(summary, labels))
+        if PROMETHEUS_TEXTFILE_DIR:
+            write_textfile(prometheus_text(summary, labels),
+                           '_'.join([STATSD_PREFIX, summary['task']] + [metric_name_part(value)
+                                                                         for value in labels.values()]))
+    except Exception as error:
+        logger.warning('Metrics of %s could not be exported: %s', summary['task'], error)
+
+
+@contextmanager
+def task_stats(task, client=None, **labels):
+    # measuring a task and exporting its summary when it ends, `client`
+    # reads the peak memory of its queries from the query log
+    STATS.reset()
+    started = time.perf_counter()
+    state = 'success'
+    try:
+        yield STATS
+    except BaseException:
+        state = 'failed'
+        raise
+    finally:
+        if client is not None and QUERY_LOG:
+            add_query_log(client)
+        export(task_summary(task, labels, time.perf_counter() - started, state), labels)
+
+
+def run_summary(dag_run):
+    # the per-run line: the duration and the state of every task instance of the run
+    tasks = [{'task': ti.task_id if ti.map_index < 0 else f'{ti.task_id}[{ti.map_index}]',
+              'state': ti.state, 'seconds': round(ti.duration, 3) if ti.duration is not None else None}
+             for ti in dag_run.get_task_instances()]
+    finished = [task for task in tasks if task['seconds'] is not None]
+    summary = {'run_id': dag_run.run_id, 'tasks': tasks,
+               'slowest': max(finished, key=lambda task: task['seconds'])['task'] if finished else None}
+    logger.info('Run summary: %s', json.dumps(summary))
+    return summary
@@ -0,0 +1,166 @@
+import hashlib
+import os
+from dataclasses import dataclass, fields
+
+FEED_ACTIONS = 'simulator_20250120.feed_actions'
+MESSAGE_ACTIONS = 'simulator_20250120.message_actions'
+
+# where the metrics with an `approximate_aggregate` use it: `baseline` for the past
+# days only (the checked interval stays exact), `always` for the checked interval
+# as well, `exact` never
+APPROXIMATION = os.environ.get('ANOMALY_DETECTION_APPROXIMATION', 'baseline')
+
+# minutes between the runs of the detection
+SCHEDULE_MINUTES = int(os.environ.get('ANOMALY_DETECTION_SCHEDULE_MINUTES', 15))
+# lengths in minutes of the intervals the metrics are checked over, every run checks
+# the intervals of each length which have closed since the previous run; all of them
+# are aggregated by the same scan of a table
+RESOLUTIONS = [int(minutes) for minutes in os.environ.get('ANOMALY_DETECTION_RESOLUTIONS', '15').split(',')]
+
+# detector the metrics are checked by, the one of anomaly_detection.detectors a metric
+# sets overrides it: `sigma` for the mean and the standard deviation of the baseline
+# queries, `mad` for the median and the median absolute deviation, `ewma` for exponentially
+# weighted statistics and `seasonal` for the residuals of a smoothed daily profile; the
+# metrics checked by the last three are read from the history cached on the worker
+DETECTOR = os.environ.get('ANOMALY_DETECTION_DETECTOR', 'sigma')
+DETECTORS = ('sigma', 'mad', 'ewma', 'seasonal')
+
+# columns the metrics are also checked by, every value of each of them separately
+# (see anomaly_detection.slices), the slices are not checked when it is empty
+SLICE_DIMENSIONS = [dimension for dimension in os.environ.get('ANOMALY_DETECTION_SLICE_DIMENSIONS', '').split(',')
+                    if dimension]
+# average number of events per interval a slice needs in the history to be checked
+SLICE_MIN_EVENTS = float(os.environ.get('ANOMALY_DETECTION_SLICE_MIN_EVENTS', 100))
+# number of the anomalous slices reported, the ones contributing the most to the totals
+SLICE_TOP = int(os.environ.get('ANOMALY_DETECTION_SLICE_TOP', 5))
+
+
+@dataclass(frozen=True)
+class Metric:
+    # name used in the alerts
+    name: str
+    # table the metric is calculated from
+    table: str
+    # column alias of the metric inside the generated queries, unique per table
+    column: str
+    # aggregate expression calculating the metric over an interval
+    aggregate: str
+    # width of the confidence interval in standard deviations
+    sigma: float = 3
+    # number of decimals the metric and expected values are reported with
+    precision: int = 0
+    # the same aggregate calculated over the 15 minutes rollup of the table
+    # (see anomaly_detection.rollup), the raw table is read when it is not set
+    rollup_aggregate: str = None
+    # cheaper estimate of `aggregate` (e.g. uniqCombined(17)(user_id) instead of
+    # uniqExact(user_id)), used according to `approximation`
+    approximate_aggregate: str = None
+    # APPROXIMATION of this metric, the global one when it is not set
+    approximation: str = None
+    # the same aggregate calculated over single events by the streaming detector
+    # (see anomaly_detection.stream): ('uniq', column), ('count',), ('count', column, value)
+    # or ('ratio', numerator, denominator); the metric is not streamed when it is not set
+    stream_aggregate: tuple = None
+    # DETECTOR of this metric, the global one when it is not set
+    detector: str = None
+    # column of the metric of the same table a ratio metric is divided by, the slices of
+    # the ratio contribute to its total by their share of it (see anomaly_detection.slices)
+    denominator: str = None
+
+
+# every metric calculated from the same table is aggregated by the same query,
+# so adding a metric (or a slice of one, e.g. uniqExactIf(user_id, os = 'iOS'))
+# costs an extra aggregate function rather than an extra scan
+METRICS = [
+    Metric(name='Number of Active Feed Users',
+           table=FEED_ACTIONS,
+           column='users',
+           aggregate='uniqExact(user_id)',
+           rollup_aggregate='uniqExactMerge(users_state)',
+           approximate_aggregate='uniqCombined(17)(user_id)',
+           stream_aggregate=('uniq', 'user_id')),
+    Metric(name='Number of Active Messenger Users',
+           table=MESSAGE_ACTIONS,
+           column='users',
+           aggregate='uniqExact(user_id)',
+           rollup_aggregate='uniqExactMerge(users_state)',
+           approximate_aggregate='uniqCombined(17)(user_id)',
+           stream_aggregate=('uniq', 'user_id')),
+    Metric(name='Number of User Views',
+           table=FEED_ACTIONS,
+           column='views',
+           aggregate="countIf(action = 'view')",
+           rollup_aggregate="sumIf(events, action = 'view')",
+           stream_aggregate=('count', 'action', 'view')),
+    Metric(name='Number of User Likes',
+           table=FEED_ACTIONS,
+           column='likes',
+           aggregate="countIf(action = 'like')",
+           rollup_aggregate="sumIf(events, action = 'like')",
+           stream_aggregate=('count', 'action', 'like')),
+    Metric(name='User CTR',
+           table=FEED_ACTIONS,
+           column='ctr',
+           aggregate="countIf(action = 'like') / nullIf(countIf(action = 'view'), 0)",
+           sigma=2,
+           precision=3,
+           rollup_aggregate="sumIf(events, action = 'like') / nullIf(sumIf(events, action = 'view'), 0)",
+           stream_aggregate=('ratio', ('count', 'action', 'like'), ('count', 'action', 'view')),
+           denominator='views'),
+    Metric(name='Number of Sent Messages',
+           table=MESSAGE_ACTIONS,
+           column='messages',
+           aggregate='count()',
+           rollup_aggregate='sum(events)',
+           stream_aggregate=('count',)),
+]
+
+METRICS_BY_NAME = {metric.name: metric for metric in METRICS}
+
+
+def metrics_by_table(metrics=METRICS):
+    tables = {}
+    for metric in metrics:
+        tables.setdefault(metric.table, []).append(metric)
+    return tables
+
+
+def approximated(metric, baseline):
+    # whether the metric is calculated by its `approximate_aggregate`
+    # in the queries of the past days (`baseline`) or of the checked interval
+    approximation = metric.approximation or APPROXIMATION
+    if approximation not in ('exact', 'baseline', 'always'):
+        raise ValueError(f'Unknown approximation {approximation!r} of {metric.name}')
+    return bool(metric.approximate_aggregate) and (approximation == 'always'
+                                                   or approximation == 'baseline' and baseline)
+
+
+def metric_detector(metric):
+    detector = metric.detector or DETECTOR
+    if detector not in DETECTORS:
+        raise ValueError(f'Unknown detector {detector!r} of {metric.name}')
+    return detector
+
+
+def check_resolutions(resolutions=RESOLUTIONS, schedule_minutes=SCHEDULE_MINUTES):
+    # the intervals have to split a day evenly and either fit into the time between
+    # two runs or consist of several of them, so every interval is checked once
+    for resolution in resolutions:
+        if 24 * 60 % resolution or (schedule_minutes % resolution and resolution % schedule_minutes):
+            raise ValueError(f'{resolution} minutes intervals do not fit the day '
+                             f'and the {schedule_minutes} minutes schedule')
+    return sorted(set(resolutions))
+
+
+def definition_hash(metrics, resolutions=RESOLUTIONS, extra=()):
+    # changes whenever a metric is added, removed or redefined or the resolutions
+    # (or the `extra` settings of the cached values) change, so the values cached
+    # for the previous definitions are not reused; the detector and the denominator only
+    # change how the values are checked, so the values cached for other ones are reused
+    definitions = sorted(repr(tuple(getattr(metric, field.name) for field in fields(metric)
+                                    if field.name not in ('detector', 'denominator'))
+                              + (approximated(metric, baseline=True),))
+                         for metric in metrics)
+    definitions.append(repr(check_resolutions(resolutions)))
+    definitions.extend(repr(value) for value in extra)
+    return hashlib.sha1('\n'.join(definitions).encode()).hexdigest()[:12]
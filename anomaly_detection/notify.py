@@ -0,0 +1,99 @@
+import functools
+import hashlib
+import logging
+import os
+import time
+import uuid
+from collections import deque
+
+import pyarrow as pa
+import pyarrow.fs
+
+from anomaly_detection.results import RESULTS_URI, filesystem_from_uri
+
+logger = logging.getLogger(__name__)
+
+# messages a bot may send to a group chat per minute, the pages of a report are
+# spaced out to stay under it instead of being throttled by Telegram
+TELEGRAM_MESSAGES_PER_MINUTE = int(os.environ.get('ANOMALY_DETECTION_TELEGRAM_MESSAGES_PER_MINUTE', 20))
+# seconds between two messages to the same chat
+TELEGRAM_MESSAGE_INTERVAL = float(os.environ.get('ANOMALY_DETECTION_TELEGRAM_MESSAGE_INTERVAL', 1))
+
+
+class RateLimiter:
+    # a sliding window of the last minute, shared by all the sends of the process
+    def __init__(self, per_minute=TELEGRAM_MESSAGES_PER_MINUTE, interval=TELEGRAM_MESSAGE_INTERVAL):
+        self.per_minute = per_minute
+        self.interval = interval
+        self.sent = deque()
+
+    def wait(self):
+        now = time.monotonic()
+        while self.sent and now - self.sent[0] >= 60:
+            self.sent.popleft()
+        delay = 0
+        if len(self.sent) >= self.per_minute:
+            delay = 60 - (now - self.sent[0])
+        if self.sent:
+            delay = max(delay, self.interval - (now - self.sent[-1]))
+        if delay > 0:
+            time.sleep(delay)
+        self.sent.append(time.monotonic())
+
+
+RATE_LIMITER = RateLimiter()
+
+
+@functools.lru_cache(maxsize=None)
+def telegram_bot(token):
+    # one bot per token and process
+    import telegram as tg
+
+    return tg.Bot(token=token)
+
+
+def sent_path(run_id, uri=RESULTS_URI):
+    # the number of the pages of the report of a run which have been sent, kept with the
+    # results, so it expires with them and a retried task on any worker finds it
+    filesystem, directory = filesystem_from_uri(uri)
+    return filesystem, f'{directory}/sent-{hashlib.sha1(run_id.encode()).hexdigest()[:12]}'
+
+
+def sent_pages(run_id, uri=RESULTS_URI):
+    filesystem, path = sent_path(run_id, uri)
+    if filesystem.get_file_info(path).type != pa.fs.FileType.File:
+        return 0
+    with filesystem.open_input_stream(path) as source:
+        return int(source.read().decode().strip())
+
+
+def mark_sent(run_id, pages, uri=RESULTS_URI):
+    filesystem, path = sent_path(run_id, uri)
+    filesystem.create_dir(os.path.dirname(path), recursive=True)
+    # writing through a temporary file so a retried task never reads a partial mark
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with filesystem.open_output_stream(tmp_path) as sink:
+        sink.write(str(pages).encode())
+    filesystem.move(tmp_path, path)
+
+
+def send_pages(token, chat_id, pages, rate_limiter=RATE_LIMITER, max_attempts=5, on_sent=None):
+    # sending the pages of a report in order, a throttled page waits as long as
+    # Telegram asks and is sent again instead of failing the task; `on_sent` is called
+    # with the number of the pages sent so far after every page
+    from telegram.error import RetryAfter
+
+    bot = telegram_bot(token)
+    for number, page in enumerate(pages, 1):
+        for attempt in range(max_attempts):
+            rate_limiter.wait()
+            try:
+                bot.send_message(chat_id=chat_id, text=page, parse_mode="HTML")
+                break
+            except RetryAfter as error:
+                if attempt == max_attempts - 1:
+                    raise
+                logger.warning('Throttled by Telegram, retrying in %s seconds', error.retry_after)
+                time.sleep(error.retry_after)
+        if on_sent:
+            on_sent(number)
@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# modules the DAG file must not import while it is parsed, the tasks import them when they run
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'requests', 'telegram', 'matplotlib', 'seaborn', 'pandahouse')
+
+DAG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'anomaly_reporter_dag.py')
+
+# run in a new interpreter every time, so nothing is imported yet; airflow itself is
+# imported before the clock starts, as the scheduler has it loaded already
+PARSE_SCRIPT = """
+import importlib.util, json, sys, time
+import airflow.decorators, airflow.operators.python
+
+before = set(sys.modules)
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('parsed_dag', sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+seconds = time.perf_counter() - started
+print(json.dumps({'seconds': seconds, 'modules': sorted(set(sys.modules) - before)}))
+"""
+
+
+def parse_once(path):
+    output = subprocess.run([sys.executable, '-c', PARSE_SCRIPT, path], check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(path)).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def heavy_imports(modules, heavy_modules=HEAVY_MODULES):
+    return sorted({module.split('.')[0] for module in modules} & set(heavy_modules))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the time the scheduler takes to parse the DAG file '
+                                                 'and fails when it is too slow or imports heavy modules')
+    parser.add_argument('--dag', default=DAG_PATH, help='DAG file to parse')
+    parser.add_argument('--runs', type=int, default=5, help='number of parses, each in a new interpreter')
+    parser.add_argument('--max-seconds', type=float, default=0.2, help='highest accepted median parse time')
+    args = parser.parse_args()
+
+    results = [parse_once(os.path.abspath(args.dag)) for _ in range(args.runs)]
+    median = statistics.median(result['seconds'] for result in results)
+    heavy = heavy_imports(results[0]['modules'])
+    print(f'Parsed {args.dag} in {median * 1000:.1f} ms (median of {args.runs}), '
+          f'{len(results[0]["modules"])} modules imported')
+
+    failures = []
+    if median > args.max_seconds:
+        failures.append(f'the parse time exceeds {args.max_seconds * 1000:.0f} ms')
+    if heavy:
+        failures.append('the DAG file imports ' + ', '.join(heavy))
+    if failures:
+        sys.exit('Parse time regression: ' + '; '.join(failures))
+
+
+if __name__ == '__main__':
+    main()
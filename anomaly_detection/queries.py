@@ -0,0 +1,261 @@
+import os
+import time
+
+from anomaly_detection.metrics import (METRICS, RESOLUTIONS, SCHEDULE_MINUTES, approximated, check_resolutions,
+                                      metrics_by_table)
+from anomaly_detection.rollup import ROLLUPS
+
+# number of past weeks, so of days of every weekday, the baseline is calculated from
+LOOKBACK_WEEKS = int(os.environ.get('ANOMALY_DETECTION_LOOKBACK_WEEKS', 52))
+# half-life of the weights of the past days in the weighted average of a weekday,
+# in weeks; the n-th day of a weekday in the lookback window has the weight n when it is 0
+HALF_LIFE_WEEKS = float(os.environ.get('ANOMALY_DETECTION_HALF_LIFE_WEEKS', 0))
+# whether the results of the baseline queries are kept in the query cache of ClickHouse
+# (23.1 or later), so the workers which do not have the baseline cached read it from there
+QUERY_CACHE = os.environ.get('ANOMALY_DETECTION_QUERY_CACHE', '1') == '1'
+
+# the queries are generated from the metric registry in anomaly_detection.metrics:
+# every metric of a table is calculated in a single grouped aggregation and then
+# turned into (metric_name, value) rows, so the statistics below are calculated
+# per metric while the table itself is scanned once per query; the values which change
+# between the runs (the day, the checked window) are query parameters, `{{name:Type}}` in
+# the templates, sent apart from the query, so the text of a query stays the same
+
+# every event is counted in its interval of each resolution: the ARRAY JOIN pairs
+# the resolutions with the starts of the intervals the event falls into, so all the
+# resolutions are aggregated by one scan of the table
+INTERVALS = """ARRAY JOIN [{resolutions}] AS resolution,
+                       [{interval_starts}] AS interval_start"""
+
+# the baseline queries only look at the `lookback` days before `day`, so their
+# result changes once a day and is cached by anomaly_detection.baseline and, with
+# `{settings}`, by the query cache of the server; the window is set on the raw `time`
+# column, so only its partitions are read
+BASELINE_QUERY = """
+        WITH
+        -- calculating all the metrics of the table for every interval
+        date_time_metrics AS
+            (SELECT toDate(interval_start) AS date,
+                    resolution,
+                    formatDateTime(interval_start, '%H:%M:%S') AS time_slot,
+                    {aggregates}
+            FROM {table}
+            {intervals}
+            WHERE time >= toDateTime({{day:Date}} - {{lookback:UInt16}})
+                AND time < toDateTime({{day:Date}})
+            GROUP BY resolution, interval_start),
+
+        -- turning the metric columns into rows
+        date_time_values AS
+            (SELECT metric_name,
+                    resolution,
+                    date,
+                    time_slot,
+                    value,
+                    sigma
+            FROM date_time_metrics
+            ARRAY JOIN [{metric_names}] AS metric_name,
+                       [{values}] AS value,
+                       [{sigmas}] AS sigma),
+
+        -- calculating average metric value throughout a day by interval for every day
+        date_time_average_values AS
+            (SELECT metric_name,
+                    resolution,
+                    date,
+                    time_slot AS time,
+                    value,
+                    sigma,
+                    AVG(value) OVER (PARTITION BY metric_name, resolution, date) AS avg_value
+            FROM date_time_values),
+
+        -- calculating the relative deviation of each metric value
+        -- from the average value related to its day
+        relative_deviation_table AS
+            (SELECT metric_name,
+                    resolution,
+                    date,
+                    time,
+                    sigma,
+                    value / avg_value AS relative_deviation
+            FROM date_time_average_values),
+
+        -- calculating the confidence interval of the relative
+        -- deviations for each interval
+        conf_int_table AS
+            (SELECT metric_name,
+                    resolution,
+                    time,
+                    AVG(relative_deviation) - any(sigma) * stddevSamp(relative_deviation) AS lower_bound,
+                    AVG(relative_deviation) + any(sigma) * stddevSamp(relative_deviation) AS upper_bound,
+                    AVG(relative_deviation) AS avg_relative_deviation
+            FROM relative_deviation_table
+            GROUP BY metric_name, resolution, time),
+
+        -- calculating the weights for every average metric value
+        -- throughout a day by interval for every day
+        date_weights_table AS
+            (SELECT metric_name,
+                    resolution,
+                    date,
+                    toDayOfWeek(date) AS weekday,
+                    avg_value,
+                    {date_weight} AS date_weight
+            FROM date_time_average_values
+            GROUP BY metric_name,
+                    resolution,
+                    date,
+                    toDayOfWeek(date) AS weekday,
+                    avg_value),
+
+        -- calculating the weighted average of every average metric value
+        -- throughout a day by interval for every day for every weekday
+        weighted_avg_calculation AS
+            (SELECT metric_name,
+                    resolution,
+                    weekday,
+                    MAX(weighted_avgs) / MAX(weights_sum) AS weighted_avg
+            FROM
+                (SELECT metric_name,
+                        resolution,
+                        weekday,
+                        SUM(avg_value * date_weight) OVER (PARTITION BY metric_name, resolution, weekday ORDER BY date) AS weighted_avgs,
+                        SUM(date_weight) OVER (PARTITION BY metric_name, resolution, weekday ORDER BY date) AS weights_sum
+                FROM date_weights_table)
+            GROUP BY metric_name, resolution, weekday)
+
+        SELECT metric_name,
+                resolution,
+                weekday,
+                time,
+                lower_bound,
+                upper_bound,
+                avg_relative_deviation,
+                weighted_avg
+        FROM conf_int_table JOIN weighted_avg_calculation USING(metric_name, resolution)
+        {settings}
+        """
+
+# the current queries only read the intervals of every resolution which have closed
+# after `start` and by `end`, the starts of schedule intervals (see checked_window)
+CURRENT_QUERY = """
+        SELECT metric_name,
+                resolution,
+                date,
+                weekday,
+                time_slot,
+                value
+        FROM
+            (SELECT resolution,
+                    toDate(interval_start) AS date,
+                    toDayOfWeek(interval_start) AS weekday,
+                    formatDateTime(interval_start, '%H:%M:%S') AS time_slot,
+                    {aggregates}
+            FROM {table}
+            {intervals}
+            WHERE time >= toDateTime({{start:UInt32}}) - toIntervalMinute({longest})
+                AND time < toDateTime({{end:UInt32}})
+                AND interval_start + toIntervalMinute(resolution) > toDateTime({{start:UInt32}})
+                AND interval_start + toIntervalMinute(resolution) <= toDateTime({{end:UInt32}})
+            GROUP BY resolution, interval_start)
+        ARRAY JOIN [{metric_names}] AS metric_name,
+                   [{values}] AS value
+        """
+
+
+def quote(value):
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def metric_aggregate(metric, rollup=None, baseline=False):
+    # the rollups keep exact states, so they are merged exactly in any case
+    if rollup:
+        return metric.rollup_aggregate
+    if approximated(metric, baseline):
+        return metric.approximate_aggregate
+    return metric.aggregate
+
+
+def render_intervals(resolutions=RESOLUTIONS):
+    resolutions = check_resolutions(resolutions)
+    return INTERVALS.format(resolutions=', '.join(str(resolution) for resolution in resolutions),
+                            interval_starts=', '.join(f'toStartOfInterval(time, toIntervalMinute({resolution}))'
+                                                      for resolution in resolutions))
+
+
+def render_query(template, table, metrics, rollup=None, baseline=False, resolutions=RESOLUTIONS, **params):
+    # the rollup of the table is read instead of its raw events when it is given,
+    # `baseline` marks the queries of the past days and `{events}` counts the
+    # events of a group in either of them
+    return template.format(table=rollup.table if rollup else table,
+                           intervals=render_intervals(resolutions),
+                           events='sum(events)' if rollup else 'count()',
+                           aggregates=',\n                    '.join(f'{metric_aggregate(metric, rollup, baseline)} '
+                                                                     f'AS {metric.column}'
+                                                                     for metric in metrics),
+                           metric_names=', '.join(quote(metric.name) for metric in metrics),
+                           values=', '.join(f'toFloat64({metric.column})' for metric in metrics),
+                           sigmas=', '.join(str(metric.sigma) for metric in metrics),
+                           **params)
+
+
+def table_rollup(table, metrics, rollup_tables, resolutions=RESOLUTIONS):
+    # the rollups hold 15 minutes intervals, so they only serve the multiples of them
+    if table in rollup_tables and all(metric.rollup_aggregate for metric in metrics) \
+            and all(resolution % 15 == 0 for resolution in resolutions):
+        return ROLLUPS[table]
+    return None
+
+
+def date_weight(half_life_weeks=HALF_LIFE_WEEKS):
+    if half_life_weeks:
+        return "exp2(-dateDiff('day', date, {day:Date}) / {half_life_days:Float64})"
+    return 'ROW_NUMBER() OVER (PARTITION BY metric_name, resolution, toDayOfWeek(date) ORDER BY date)'
+
+
+def query_cache_settings(ttl_seconds):
+    if not QUERY_CACHE or not ttl_seconds:
+        return ''
+    return f'SETTINGS use_query_cache = 1, query_cache_ttl = {int(ttl_seconds)}'
+
+
+def baseline_queries(metrics=METRICS, rollup_tables=(), half_life_weeks=HALF_LIFE_WEEKS, resolutions=RESOLUTIONS,
+                     cache_ttl_seconds=0):
+    # the results are kept in the query cache for `cache_ttl_seconds`, not at all when it is 0
+    return {table: render_query(BASELINE_QUERY, table, table_metrics,
+                                rollup=table_rollup(table, table_metrics, rollup_tables, resolutions),
+                                baseline=True, resolutions=resolutions,
+                                date_weight=date_weight(half_life_weeks),
+                                settings=query_cache_settings(cache_ttl_seconds))
+            for table, table_metrics in metrics_by_table(metrics).items()}
+
+
+def baseline_params(day, lookback_weeks=LOOKBACK_WEEKS, half_life_weeks=HALF_LIFE_WEEKS):
+    params = {'day': day, 'lookback': 7 * lookback_weeks}
+    if half_life_weeks:
+        params['half_life_days'] = 7 * half_life_weeks
+    return params
+
+
+def checked_window(end=None, start=None, schedule_minutes=SCHEDULE_MINUTES):
+    # the parameters of the checked intervals, the ones which close after `start` and by `end`;
+    # both are the Unix times of the starts of schedule intervals (see anomaly_detection.catchup),
+    # by default the intervals which have closed since the previous run by the clock of the worker
+    seconds = schedule_minutes * 60
+    if end is None:
+        end = int(time.time()) // seconds * seconds
+    if start is None:
+        start = end - seconds
+    return {'start': start, 'end': end}
+
+
+# the day of the intervals the next runs check, the one of `end` of checked_window in the time zone of the server
+CURRENT_DAY_QUERY = 'SELECT toDate(toDateTime({end:UInt32})) AS day'
+
+
+def current_queries(metrics=METRICS, rollup_tables=(), resolutions=RESOLUTIONS):
+    # the window of the checked intervals is given by the parameters of checked_window
+    return {table: render_query(CURRENT_QUERY, table, table_metrics,
+                                rollup=table_rollup(table, table_metrics, rollup_tables, resolutions),
+                                resolutions=resolutions, longest=max(resolutions))
+            for table, table_metrics in metrics_by_table(metrics).items()}
@@ -0,0 +1,120 @@
+from anomaly_detection.metrics import SLICE_TOP
+
+# the module only works on the data frame it is given, so the DAG file imports it
+# without pandas
+NO_ANOMALIES_MESSAGE = "No anomalies have been detected"
+DASHBOARD_LINK = "http://superset.lab.karpov.courses/r/6292"
+# length of a Telegram message, the longer reports are sent as several pages
+MESSAGE_LIMIT = 4096
+
+SINGLE_TEMPLATE = "An anomaly has been detected in {metric_name} from <b>{start_time}</b> to <b>{finish_time}</b>. "\
+    "Current value is <b>{metric_value}</b>, deviating by <b>{change}</b>% from the average expected "\
+    "<b>{avg_expected_value}</b>.\n\n"\
+    'Click <a href="{dashboard_link}">the link</a> to view real-time metric changes.'
+SEVERAL_TEMPLATE = "Anomalies have been detected in several metrics from <b>{start_time}</b> to <b>{finish_time}</b>:\n"\
+    "{lines}\n"\
+    'Click <a href="{dashboard_link}">the link</a> to view real-time metrics changes.'
+LINE_TEMPLATE = "- {metric_name}: current value is <b>{metric_value}</b>, "\
+    "deviating by <b>{change}%</b> from the expected <b>{avg_expected_value}</b>\n"
+SLICE_TEMPLATE = "- {metric_name} ({start_time}, {resolution} min) in {dimension} <b>{slice}</b>: "\
+    "current value is <b>{metric_value}</b>, deviating by <b>{change}%</b> from the expected "\
+    "<b>{avg_expected_value}</b>, <b>{contribution}%</b> of the expected total\n"
+ONLY_SLICES_TEMPLATE = "No anomalies have been detected in the metrics, but they have been detected "\
+    "in the following slices:\n{slice_lines}"
+SLICES_TEMPLATE = "\n\nThe following slices have deviated the most:\n{slice_lines}"
+FAILED_TEMPLATE = "\n\nThe following metrics could not be checked: {metric_names}."
+RESOLVED_TEMPLATE = "The following anomalies have ended: {incidents}."
+RESOLVED_INCIDENT_TEMPLATE = "{metric_name} ({resolution} min, since {started})"
+# the mark of the open incidents which are reported again (see anomaly_detection.incidents)
+ESCALATED_MARK = " (still growing)"
+PAGE_TEMPLATE = "{page}\n\n({number}/{pages})"
+# the times of the intervals, with their date when the report has the intervals of several days
+TIME_FORMAT = '%H:%M'
+DATE_TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+
+def interval_columns(df, time_format=TIME_FORMAT):
+    # the start and finish of the intervals, computed for all the rows at once
+    # from their full timestamps and formatted with `time_format`
+    import pandas as pd
+
+    start = pd.to_datetime(df.date.astype(str) + ' ' + df.time.astype(str))
+    finish = start + pd.to_timedelta(df.resolution.astype(int), unit='min')
+    return df.assign(start=start,
+                     finish=finish,
+                     start_time=start.dt.strftime(time_format),
+                     finish_time=finish.dt.strftime(time_format),
+                     resolution=df.resolution.astype(int))
+
+
+def render_lines(template, df):
+    return ''.join(template.format(**row) for row in df.to_dict('records'))
+
+
+def format_report(df, resolved=(), slice_top=SLICE_TOP, dashboard_link=DASHBOARD_LINK):
+    # the message of the combined results of a run, every row is rendered once;
+    # `resolved` are the incidents the run has found over
+    failed = df[df.error.notna()]
+    time_format = DATE_TIME_FORMAT if df.date[df.error.isna()].nunique() > 1 else TIME_FORMAT
+    if 'state' in df:
+        df = df.assign(metric_name=df.metric_name.where(df.state != 'escalated', df.metric_name + ESCALATED_MARK))
+    # the anomalous slices are reported after the metrics as the list of their
+    # possible causes, the ones contributing the most to the deviation of the totals first
+    slices = df[df.error.isna() & df.dimension.notna()]
+    slices = interval_columns(slices.loc[slices.contribution.abs().sort_values(ascending=False).index[:slice_top]],
+                              time_format)
+    slice_lines = render_lines(SLICE_TEMPLATE, slices)
+
+    df = interval_columns(df[df.error.isna() & df.dimension.isna()].reset_index(drop=True), time_format)
+    # the report may have the intervals of several resolutions and times (e.g. the metrics
+    # left after the incidents are filtered, or a catch-up), then every line has its own
+    if len(df[['start', 'resolution']].drop_duplicates()) > 1:
+        df['metric_name'] = df.metric_name.astype(str) + ' (' + df.start_time + ', ' \
+            + df.resolution.astype(str) + ' min)'
+
+    if df.empty:
+        # the failed metrics and the ended incidents are reported on their own, as the metrics
+        # which could not be checked and the incidents still open may well be anomalous
+        message = ONLY_SLICES_TEMPLATE.format(slice_lines=slice_lines) if slice_lines else ''
+    elif len(df) == 1:
+        message = SINGLE_TEMPLATE.format(**df.iloc[0].to_dict(), dashboard_link=dashboard_link)
+    else:
+        # the intervals of several resolutions and days may be reported together
+        message = SEVERAL_TEMPLATE.format(start_time=df.start_time[df.start.idxmin()],
+                                          finish_time=df.finish_time[df.finish.idxmax()],
+                                          lines=render_lines(LINE_TEMPLATE, df), dashboard_link=dashboard_link)
+    if not df.empty and slice_lines:
+        message += SLICES_TEMPLATE.format(slice_lines=slice_lines)
+    if not failed.empty:
+        message += FAILED_TEMPLATE.format(metric_names=', '.join(failed.metric_name))
+    if resolved:
+        resolved_message = RESOLVED_TEMPLATE.format(incidents=', '.join(RESOLVED_INCIDENT_TEMPLATE.format(**incident)
+                                                                         for incident in resolved))
+        message += f'\n\n{resolved_message}'
+    return message.lstrip('\n') or NO_ANOMALIES_MESSAGE
+
+
+def paginate(message, limit=MESSAGE_LIMIT):
+    # splitting a long report between its lines, so the HTML tags of a line are never
+    # split; a page is numbered when there are several, its number takes some of the limit
+    reserve = len(PAGE_TEMPLATE.format(page='', number=999, pages=999))
+    if len(message) <= limit:
+        return [message]
+
+    pages, page = [], ''
+    for line in message.splitlines(keepends=True):
+        # a line longer than a page is cut anyway
+        while len(line) > limit - reserve:
+            if page:
+                pages.append(page)
+                page = ''
+            pages.append(line[:limit - reserve])
+            line = line[limit - reserve:]
+        if len(page) + len(line) > limit - reserve:
+            pages.append(page)
+            page = ''
+        page += line
+    if page:
+        pages.append(page)
+    return [PAGE_TEMPLATE.format(page=page.rstrip('\n'), number=number, pages=len(pages))
+            for number, page in enumerate(pages, 1)]
@@ -0,0 +1,72 @@
+import os
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.fs
+
+from anomaly_detection.baseline import CACHE_DIR
+from anomaly_detection.detection import RESULT_COLUMNS
+
+# the results of the tasks are passed as references to Arrow files instead of pickled
+# data frames in XCom, so the metadata database only stores a path whatever the size of
+# the results; it has to be reachable by every worker, a shared directory or an object
+# storage URI such as s3://bucket/prefix
+RESULTS_URI = os.environ.get('ANOMALY_DETECTION_RESULTS_URI', os.path.join(CACHE_DIR, 'results'))
+# hours the result files are kept for, so the retried tasks still find them
+RESULTS_TTL_HOURS = float(os.environ.get('ANOMALY_DETECTION_RESULTS_TTL_HOURS', 24))
+
+RESULT_SCHEMA = pa.schema([
+    ('metric_name', pa.string()),
+    ('resolution', pa.uint16()),
+    ('date', pa.string()),
+    ('time', pa.string()),
+    ('relative_deviation', pa.float64()),
+    ('lower_bound', pa.float64()),
+    ('upper_bound', pa.float64()),
+    ('avg_relative_deviation', pa.float64()),
+    ('avg_expected_value', pa.string()),
+    ('metric_value', pa.string()),
+    ('change', pa.string()),
+    ('dimension', pa.string()),
+    ('slice', pa.string()),
+    ('contribution', pa.float64()),
+    ('error', pa.string()),
+])
+
+
+def filesystem_from_uri(uri):
+    # a local path or the URI of any filesystem pyarrow supports
+    return pa.fs.FileSystem.from_uri(uri if '://' in uri else os.path.abspath(uri))
+
+
+def evict_results(filesystem, directory, ttl_hours=RESULTS_TTL_HOURS):
+    expired = time.time() - ttl_hours * 3600
+    for info in filesystem.get_file_info(pa.fs.FileSelector(directory)):
+        if info.type == pa.fs.FileType.File and info.mtime is not None and info.mtime.timestamp() < expired:
+            filesystem.delete_file(info.path)
+
+
+def write_results(df, name, uri=RESULTS_URI):
+    # the reference passed to the next task, empty when there is nothing to report; it is
+    # never None, as Airflow does not push a None result and the mapped results would be missing
+    if df.empty:
+        return ''
+    filesystem, directory = filesystem_from_uri(uri)
+    filesystem.create_dir(directory, recursive=True)
+    evict_results(filesystem, directory)
+
+    # every attempt writes its own file, so a retried task never overwrites
+    # the file another task may be reading
+    file_name = f'{name}-{uuid.uuid4().hex}.arrow'
+    table = pa.Table.from_pandas(df.reindex(columns=RESULT_COLUMNS), schema=RESULT_SCHEMA, preserve_index=False)
+    with filesystem.open_output_stream(f'{directory}/{file_name}') as sink, \
+            pa.ipc.new_stream(sink, RESULT_SCHEMA) as writer:
+        writer.write_table(table)
+    return f"{uri.rstrip('/')}/{file_name}"
+
+
+def read_results(reference):
+    filesystem, path = filesystem_from_uri(reference)
+    with filesystem.open_input_stream(path) as source:
+        return pa.ipc.open_stream(source).read_all().to_pandas()
@@ -0,0 +1,180 @@
+import argparse
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from anomaly_detection.clickhouse import ClickHouseClient, connection_from_env
+from anomaly_detection.metrics import FEED_ACTIONS, MESSAGE_ACTIONS
+
+logger = logging.getLogger(__name__)
+
+# database the rollups are created in, the rollups are not used when it is not set
+ROLLUP_DATABASE = os.environ.get('ANOMALY_DETECTION_ROLLUP_DATABASE')
+
+
+@dataclass(frozen=True)
+class Rollup:
+    # raw table the rollup is filled from
+    source: str
+    # columns the events are grouped by besides the 15 minutes interval
+    dimensions: tuple
+
+    @property
+    def table(self):
+        return f"{ROLLUP_DATABASE}.{self.source.split('.')[-1]}_15m"
+
+    @property
+    def view(self):
+        return f'{self.table}_mv'
+
+
+# the rollup keeps the 15 minutes interval start in the `time` column, so the
+# detection queries read it exactly like the raw table, with the
+# `rollup_aggregate` of the metrics instead of their `aggregate`
+ROLLUPS = {
+    FEED_ACTIONS: Rollup(source=FEED_ACTIONS, dimensions=('action', 'os', 'country', 'source')),
+    MESSAGE_ACTIONS: Rollup(source=MESSAGE_ACTIONS, dimensions=('os', 'country', 'source')),
+}
+
+CREATE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS {table}
+    (
+        time DateTime,
+        {dimension_columns},
+        users_state AggregateFunction(uniqExact, UInt32),
+        events SimpleAggregateFunction(sum, UInt64)
+    )
+    ENGINE = AggregatingMergeTree
+    PARTITION BY toYYYYMM(time)
+    ORDER BY (time, {dimensions})
+    """
+
+CREATE_VIEW_QUERY = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS {view} TO {table} AS
+    {select}
+    """
+
+ROLLUP_SELECT = """
+    SELECT slot AS time,
+            {dimensions},
+            uniqExactState(user_id) AS users_state,
+            count() AS events
+    FROM
+        (SELECT toStartOfInterval(time, toIntervalMinute(15)) AS slot,
+                user_id,
+                {dimensions}
+        FROM {source}
+        {where})
+    GROUP BY slot, {dimensions}
+    """
+
+# the rollup is up to date when the last closed 15 minutes interval has reached it
+FRESHNESS_QUERY = """
+    SELECT max(time) >= toStartOfInterval(now() - toIntervalMinute(15), toIntervalMinute(15)) AS fresh
+    FROM {table}
+    WHERE time >= now() - toIntervalHour(1)
+    """
+
+
+def rollup_select(rollup, where=''):
+    return ROLLUP_SELECT.format(source=rollup.source, dimensions=', '.join(rollup.dimensions), where=where)
+
+
+def create(client, rollup):
+    client.execute(CREATE_TABLE_QUERY.format(table=rollup.table,
+                                             dimension_columns=',\n        '.join(f'{dimension} String'
+                                                                                for dimension in rollup.dimensions),
+                                             dimensions=', '.join(rollup.dimensions)))
+    client.execute(CREATE_VIEW_QUERY.format(view=rollup.view, table=rollup.table, select=rollup_select(rollup)))
+
+
+def drop(client, rollup):
+    client.execute(f'DROP VIEW IF EXISTS {rollup.view}')
+    client.execute(f'DROP TABLE IF EXISTS {rollup.table}')
+
+
+def view_created_at(client, rollup):
+    database, view = rollup.view.split('.')
+    df = client.read(f"SELECT metadata_modification_time FROM system.tables WHERE database = '{database}' AND name = '{view}'")
+    if df.empty:
+        raise RuntimeError(f'{rollup.view} does not exist, create the rollup first')
+    return datetime.fromisoformat(df.metadata_modification_time[0])
+
+
+def backfill(client, rollup, since=None, before=None):
+    # the events inserted before the view was created are copied day by day, a day
+    # whose rows already count all the events of the source is skipped, so an interrupted
+    # backfill can be started again; a day filled in part (e.g. by a failed insert) is filled again
+    before = before or view_created_at(client, rollup)
+    if since is None:
+        since = client.read(f'SELECT min(toDate(time)) AS since FROM {rollup.source}').since[0]
+    start = datetime.combine(datetime.fromisoformat(str(since)).date(), datetime.min.time())
+
+    while start < before:
+        end = min(start + timedelta(days=1), before)
+        # the interval `before` falls into is compared and filled as a whole, as its events
+        # after `before` are already in the rollup from the view, so the backfill is best
+        # started once that interval has closed
+        interval = f"time >= toDateTime('{start:%Y-%m-%d %H:%M:%S}') "\
+                   f"AND time < toStartOfInterval(toDateTime('{end:%Y-%m-%d %H:%M:%S}') - 1, toIntervalMinute(15)) "\
+                   f"+ toIntervalMinute(15)"
+
+        filled = client.read(f'SELECT sum(events) AS events FROM {rollup.table} WHERE {interval}').events[0]
+        events = client.read(f'SELECT count() AS events FROM {rollup.source} WHERE {interval}').events[0]
+        if filled == events:
+            logger.info('Skipping %s of %s, it is already filled', start.date(), rollup.table)
+        else:
+            logger.info('Filling %s of %s, %s of its %s events are in the rollup', start.date(), rollup.table,
+                        filled, events)
+            if filled:
+                client.execute(f'DELETE FROM {rollup.table} WHERE {interval}')
+            client.execute(f'INSERT INTO {rollup.table} {rollup_select(rollup, where=f"WHERE {interval}")}')
+        start = end
+
+
+def fresh_rollups(client, tables):
+    # the tables whose rollup can be read by the detection queries, a table
+    # falls back to its raw events when its rollup is missing or lags behind
+    if not ROLLUP_DATABASE:
+        return set()
+    rollups = {table: ROLLUPS[table] for table in tables if table in ROLLUPS}
+    results, errors = client.read_many({table: FRESHNESS_QUERY.format(table=rollup.table)
+                                        for table, rollup in rollups.items()})
+    for table in errors:
+        logger.warning('Rollup of %s is not available, reading the raw table', table)
+    fresh = {table for table, df in results.items() if not df.empty and df.fresh[0] == 1}
+    for table in set(results) - fresh:
+        logger.warning('Rollup of %s lags behind, reading the raw table', table)
+    return fresh
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manages the 15 minutes rollups the anomaly detection reads from')
+    parser.add_argument('command', choices=['create', 'backfill', 'drop'])
+    parser.add_argument('--table', choices=list(ROLLUPS), help='source table, all of them by default')
+    parser.add_argument('--since', help='first day to backfill, the first day of the source table by default')
+    parser.add_argument('--before', type=datetime.fromisoformat,
+                        help='time to backfill up to, the creation time of the materialized view by default')
+    args = parser.parse_args()
+
+    if not ROLLUP_DATABASE:
+        parser.error('ANOMALY_DETECTION_ROLLUP_DATABASE is not set')
+    connection = connection_from_env(ROLLUP_DATABASE)
+    rollups = [ROLLUPS[args.table]] if args.table else list(ROLLUPS.values())
+
+    logging.basicConfig(level=logging.INFO)
+    with ClickHouseClient(connection) as client:
+        for rollup in rollups:
+            if args.command == 'create':
+                create(client, rollup)
+            elif args.command == 'backfill':
+                # the backfill reads whole days of raw events, so it is not limited by the query timeout
+                client.timeout = 3600
+                backfill(client, rollup, since=args.since, before=args.before)
+            else:
+                drop(client, rollup)
+
+
+if __name__ == '__main__':
+    main()
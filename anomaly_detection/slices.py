@@ -0,0 +1,218 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from anomaly_detection.baseline import CACHE_DIR
+from anomaly_detection.clickhouse import ClickHouseError
+from anomaly_detection.detection import RESULT_COLUMNS, format_results
+from anomaly_detection.engine import DAY_MINUTES, detect, slot_indexes
+from anomaly_detection.history import HISTORY_DAYS, day_path, history_days, history_dir, read_day, update_history
+from anomaly_detection.metrics import METRICS, RESOLUTIONS, SLICE_DIMENSIONS, SLICE_MIN_EVENTS, metrics_by_table
+from anomaly_detection.queries import HALF_LIFE_WEEKS, checked_window, quote, render_query, table_rollup
+from anomaly_detection.rollup import ROLLUPS
+
+# every event is counted once more in its value of each dimension: the second ARRAY JOIN
+# repeats it for every dimension with the 'dimension=value' key of the slice, the empty
+# key standing for the whole table, so the totals and all the slices are aggregated
+# by the same scan of the table
+SLICES = "ARRAY JOIN ['', {slice_keys}] AS slice_key"
+
+# the slice history is kept like the history of the totals (see anomaly_detection.history)
+# with the number of events of every slice, which decides whether it is checked
+SLICE_HISTORY_QUERY = """
+        SELECT toDate(interval_start) AS date,
+                resolution,
+                intDiv(toHour(interval_start) * 60 + toMinute(interval_start), resolution) AS slot,
+                slice_key,
+                {events} AS event_count,
+                {aggregates}
+        FROM {table}
+        {intervals}
+        {slices}
+        WHERE time >= toDateTime({{first_day:Date}}) AND time < toDateTime({{last_day:Date}} + 1)
+            AND has({{days:Array(Date)}}, toDate(time))
+        GROUP BY resolution, interval_start, slice_key
+        """
+
+# the intervals of the current queries, one column per metric
+SLICE_CURRENT_QUERY = """
+        SELECT resolution,
+                toDate(interval_start) AS date,
+                toDayOfWeek(interval_start) AS weekday,
+                formatDateTime(interval_start, '%H:%M:%S') AS time_slot,
+                slice_key,
+                {aggregates}
+        FROM {table}
+        {intervals}
+        {slices}
+        WHERE time >= toDateTime({{start:UInt32}}) - toIntervalMinute({longest})
+            AND time < toDateTime({{end:UInt32}})
+            AND interval_start + toIntervalMinute(resolution) > toDateTime({{start:UInt32}})
+            AND interval_start + toIntervalMinute(resolution) <= toDateTime({{end:UInt32}})
+        GROUP BY resolution, interval_start, slice_key
+        """
+
+
+def render_slices(dimensions=SLICE_DIMENSIONS):
+    return SLICES.format(slice_keys=', '.join(f"concat({quote(dimension + '=')}, toString({dimension}))"
+                                              for dimension in dimensions))
+
+
+def slice_schema(table_metrics):
+    return pa.schema([('resolution', pa.uint16()), ('slot', pa.uint16()),
+                      ('slice_key', pa.string()), ('event_count', pa.float64())]
+                     + [(metric.column, pa.float64()) for metric in table_metrics])
+
+
+def with_denominators(metrics):
+    # the denominators of the ratio metrics are aggregated for their slices as well
+    columns = {(metric.table, metric.column) for metric in metrics}
+    denominators = {(metric.table, metric.denominator) for metric in metrics if metric.denominator}
+    return list(metrics) + [metric for metric in METRICS
+                            if (metric.table, metric.column) in denominators - columns]
+
+
+def slice_rollups(rollup_tables, dimensions=SLICE_DIMENSIONS):
+    # a rollup only serves the slices when it keeps all the dimensions
+    return {table for table in rollup_tables if set(dimensions) <= set(ROLLUPS[table].dimensions)}
+
+
+def slice_current_queries(metrics=METRICS, rollup_tables=(), dimensions=SLICE_DIMENSIONS, resolutions=RESOLUTIONS):
+    # the window of the checked intervals is given by the parameters of queries.checked_window
+    return {table: render_query(SLICE_CURRENT_QUERY, table, table_metrics,
+                                rollup=table_rollup(table, table_metrics, rollup_tables, resolutions),
+                                resolutions=resolutions,
+                                slices=render_slices(dimensions),
+                                longest=max(resolutions))
+            for table, table_metrics in metrics_by_table(metrics).items()}
+
+
+def load_slices(day, table_metrics, resolution, dimensions=SLICE_DIMENSIONS, cache_dir=CACHE_DIR, days=HISTORY_DAYS):
+    # the slice history of `resolution` as a (days x slots x slices x metrics) array of the
+    # values and a (days x slots x slices) array of the event counts, together with the ISO
+    # weekday of every day and the key of every slice, the totals first
+    directory = history_dir(table_metrics[0].table, table_metrics, cache_dir, 'slices', dimensions)
+    window = history_days(day, days)
+    columns = [metric.column for metric in table_metrics]
+
+    frames = []
+    for i, past_day in enumerate(window):
+        if os.path.exists(day_path(directory, past_day)):
+            df = read_day(day_path(directory, past_day)).to_pandas()
+            frames.append(df[df.resolution == resolution].assign(day=i))
+    df = pd.concat(frames, ignore_index=True) if frames else \
+        pd.DataFrame(columns=slice_schema(table_metrics).names + ['day'])
+    # the empty key of the totals is read back as null
+    df['slice_key'] = df.slice_key.fillna('')
+
+    slices = sorted(set(df.slice_key) | {''})
+    codes = pd.Index(slices).get_indexer(df.slice_key)
+    days_index, slots = df.day.to_numpy(dtype=int), df.slot.to_numpy(dtype=int)
+
+    values = np.full((len(window), DAY_MINUTES // resolution, len(slices), len(table_metrics)), np.nan)
+    values[days_index, slots, codes] = df[columns].to_numpy(dtype=float)
+    events = np.zeros(values.shape[:3])
+    events[days_index, slots, codes] = df.event_count.to_numpy(dtype=float)
+    weekdays = np.array([past_day.isoweekday() for past_day in window])
+    return values, events, weekdays, slices
+
+
+def detect_slice_resolution(day, current, table_metrics, resolution, dimensions=SLICE_DIMENSIONS,
+                            min_events=SLICE_MIN_EVENTS, cache_dir=CACHE_DIR):
+    # all the slices and the totals of the table are checked as the columns of one
+    # batch, the slices with fewer than `min_events` events per interval on average
+    # are too noisy and are left out
+    values, events, weekdays, slices = load_slices(day, table_metrics, resolution, dimensions, cache_dir)
+    kept = events.mean(axis=(0, 1)) >= min_events
+    kept[0] = True
+    values, slices = values[:, :, kept], [key for key, keep in zip(slices, kept) if keep]
+    days, slots, slice_count, metric_count = values.shape
+
+    index = pd.Index(slices)
+    current = current[index.get_indexer(current.slice_key) >= 0]
+    intervals = current[['weekday', 'time_slot']].drop_duplicates().reset_index(drop=True)
+    rows = pd.MultiIndex.from_frame(intervals).get_indexer(pd.MultiIndex.from_frame(current[['weekday', 'time_slot']]))
+    codes = index.get_indexer(current.slice_key)
+    checked_values = np.full((len(intervals), slice_count, metric_count), np.nan)
+    checked_values[rows, codes] = current[[metric.column for metric in table_metrics]].to_numpy(dtype=float)
+
+    result = detect(values.reshape(days, slots, -1), weekdays,
+                    np.tile(np.array([metric.sigma for metric in table_metrics], dtype=float), slice_count),
+                    checked_values.reshape(len(intervals), -1),
+                    slot_indexes(intervals.time_slot, slots),
+                    intervals.weekday.to_numpy(dtype=int),
+                    HALF_LIFE_WEEKS)
+    result = {name: column.reshape(checked_values.shape) for name, column in result.items()}
+
+    # the deviation of a slice from its expected value in percent of the expected total,
+    # the deviation of a ratio weighted by the share of the slice in its denominator, so the
+    # contributions of all the values of a dimension add up to the change of the total
+    # (of a ratio, at the current shares of the slices)
+    columns = [metric.column for metric in table_metrics]
+    weights = np.ones(checked_values.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for j, metric in enumerate(table_metrics):
+            if metric.denominator:
+                denominator = checked_values[:, :, columns.index(metric.denominator)]
+                weights[:, :, j] = denominator / denominator[:, :1]
+        contribution = weights * (checked_values - result['expected_value']) * 100 / result['expected_value'][:, :1]
+    # the totals are checked on their own, so only the slices are reported here
+    result['anomaly'][:, 0] = False
+
+    interval_indexes, slice_indexes, metric_indexes = np.nonzero(result['anomaly'])
+    df = pd.DataFrame({name: column[interval_indexes, slice_indexes, metric_indexes]
+                       for name, column in result.items()})
+    df['value'] = checked_values[interval_indexes, slice_indexes, metric_indexes]
+    df['contribution'] = contribution[interval_indexes, slice_indexes, metric_indexes].round(2)
+    df['metric_name'] = np.array([metric.name for metric in table_metrics])[metric_indexes]
+    df['resolution'] = resolution
+    df['date'] = day.isoformat()
+    df['time'] = intervals.time_slot.to_numpy()[interval_indexes]
+    df['dimension'] = [slices[i].partition('=')[0] for i in slice_indexes]
+    df['slice'] = [slices[i].partition('=')[2] for i in slice_indexes]
+    return df
+
+
+def update_slices(client, day, metrics=METRICS, rollup_tables=(), dimensions=SLICE_DIMENSIONS, cache_dir=CACHE_DIR):
+    # `rollup_tables` are the ones of slice_rollups
+    update_history(client, day, metrics, rollup_tables, cache_dir, query=SLICE_HISTORY_QUERY, kind='slices',
+                   schema=slice_schema, definition=dimensions, slices=render_slices(dimensions))
+
+
+def detect_slices(client, metrics=METRICS, rollup_tables=(), dimensions=SLICE_DIMENSIONS, cache_dir=CACHE_DIR,
+                  end=None, start=None):
+    # the anomalous slices of the intervals closed after `start` and by `end` (see
+    # queries.checked_window); all of them are returned, so the incidents of the slices
+    # left out of the report are still tracked, and the report picks the ones which
+    # contribute the most to the deviation of the totals
+    names = [metric.name for metric in metrics]
+    metrics = with_denominators(metrics)
+    tables = metrics_by_table(metrics)
+    rollup_tables = slice_rollups(rollup_tables, dimensions)
+    results, errors = client.read_many(slice_current_queries(metrics, rollup_tables, dimensions),
+                                       checked_window(end, start))
+    if errors:
+        raise ClickHouseError('Slice queries failed for ' + ', '.join(errors))
+    # the empty key of the totals is read as NaN
+    results = {table: df.fillna({'slice_key': ''}) for table, df in results.items() if not df.empty}
+    if not results:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+
+    # a catch-up may check the intervals of several days, each one against the history
+    # before its day; the days go in order, so the history only moves forward
+    frames = []
+    for value_date in sorted({value_date for df in results.values() for value_date in df.date.unique()}):
+        day = pd.Timestamp(value_date).date()
+        update_slices(client, day, metrics, rollup_tables, dimensions, cache_dir)
+        for table, current in results.items():
+            for resolution, resolution_current in current[current.date == value_date].groupby('resolution'):
+                frames.append(detect_slice_resolution(day, resolution_current, tables[table], resolution,
+                                                      dimensions, cache_dir=cache_dir))
+
+    df = pd.concat(frames, ignore_index=True)
+    df = df[df.metric_name.isin(names)]
+    if df.empty:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return format_results(df)
@@ -0,0 +1,287 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from anomaly_detection.baseline import load_baseline
+from anomaly_detection.clickhouse import ClickHouseClient, connection_from_env
+from anomaly_detection.detection import format_results
+from anomaly_detection.metrics import METRICS, RESOLUTIONS, check_resolutions, metrics_by_table
+
+logger = logging.getLogger(__name__)
+
+# seconds the events of a closed interval are still accepted for
+STREAM_LATENESS = int(os.environ.get('ANOMALY_DETECTION_STREAM_LATENESS', 60))
+# part of the interval which has to pass before its value is pro-rated and checked
+STREAM_MIN_FRACTION = float(os.environ.get('ANOMALY_DETECTION_STREAM_MIN_FRACTION', 0.2))
+# seconds between the checks of the open interval
+STREAM_CHECK_INTERVAL = float(os.environ.get('ANOMALY_DETECTION_STREAM_CHECK_INTERVAL', 1))
+
+
+class Uniq:
+    # the distinct values of a column, it only grows within an interval
+    # so its partial value is never pro-rated
+    additive = False
+
+    def __init__(self, column):
+        self.column = column
+        self.values = set()
+
+    def add(self, event):
+        self.values.add(event[self.column])
+
+    def value(self):
+        return len(self.values)
+
+
+class Count:
+    additive = True
+
+    def __init__(self, column=None, value=None):
+        self.column, self.expected = column, value
+        self.count = 0
+
+    def add(self, event):
+        if self.column is None or event.get(self.column) == self.expected:
+            self.count += 1
+
+    def value(self):
+        return self.count
+
+
+class Ratio:
+    # a ratio of counts does not depend on the length of the interval
+    additive = None
+
+    def __init__(self, numerator, denominator):
+        self.numerator, self.denominator = numerator, denominator
+
+    def add(self, event):
+        self.numerator.add(event)
+        self.denominator.add(event)
+
+    def value(self):
+        denominator = self.denominator.value()
+        return self.numerator.value() / denominator if denominator else np.nan
+
+
+def accumulator(spec):
+    kind, *args = spec
+    if kind == 'uniq':
+        return Uniq(*args)
+    if kind == 'count':
+        return Count(*args)
+    if kind == 'ratio':
+        return Ratio(*(accumulator(arg) for arg in args))
+    raise ValueError(f'Unknown stream aggregate {spec!r}')
+
+
+def floor_slot(event_time, resolution):
+    minutes = (event_time.hour * 60 + event_time.minute) // resolution * resolution
+    return datetime.combine(event_time.date(), datetime.min.time()) + timedelta(minutes=minutes)
+
+
+class StreamDetector:
+    # keeps the running aggregates of the open intervals of one table and
+    # checks them against the baseline cached by the DAG: the open interval is checked
+    # with its value pro-rated to the whole interval, and it is checked once more
+    # when it closes; the event times drive the clock, so at most the open interval
+    # and the ones within the lateness are kept in memory
+    def __init__(self, client, metrics, sink, resolution=None, lateness=STREAM_LATENESS,
+                 min_fraction=STREAM_MIN_FRACTION, check_interval=STREAM_CHECK_INTERVAL):
+        self.client = client
+        # the baseline is read for all the metrics of the table, so it is the one cached by the DAG
+        self.table_metrics = metrics
+        self.metrics = [metric for metric in metrics if metric.stream_aggregate]
+        self.sink = sink
+        # the shortest of the resolutions by default, the one reporting the soonest
+        self.resolution = resolution or check_resolutions(RESOLUTIONS)[0]
+        self.slot = timedelta(minutes=self.resolution)
+        self.lateness = timedelta(seconds=lateness)
+        self.min_fraction = min_fraction
+        self.check_interval = check_interval
+
+        self.slots = {}
+        # the first interval checked, the one the first event falls into began
+        # before the detector did, so its events are only partly consumed
+        self.checked_from = None
+        self.closed_before = None
+        self.watermark = None
+        self.last_check = 0
+        self.baseline_day, self.baseline = None, {}
+        self.baseline_retry = 0
+        # a metric alerts once per interval, when it is first found anomalous
+        self.alerted = set()
+        self.late_events = 0
+
+    def load_baseline(self, day):
+        # a failed baseline leaves the detector without checks until it is read again
+        if day == self.baseline_day or time.monotonic() < self.baseline_retry:
+            return day == self.baseline_day
+        try:
+            df = load_baseline(self.client, day, self.table_metrics)
+        except Exception as error:
+            logger.error('Baseline of %s could not be read, retrying in a minute: %s', day, error)
+            self.baseline_retry = time.monotonic() + 60
+            return False
+        df = df.reset_index()
+        df = df[df.resolution == self.resolution]
+        self.baseline = {(row.metric_name, row.weekday, row.time): row for row in df.itertuples(index=False)}
+        self.baseline_day = day
+        return True
+
+    def consume(self, event):
+        event_time = datetime.fromisoformat(str(event['time']))
+        slot = floor_slot(event_time, self.resolution)
+        if self.checked_from is None:
+            self.checked_from = slot + self.slot
+        if self.closed_before and slot < self.closed_before:
+            self.late_events += 1
+            return
+
+        if slot not in self.slots:
+            self.slots[slot] = [accumulator(metric.stream_aggregate) for metric in self.metrics]
+        for aggregate in self.slots[slot]:
+            aggregate.add(event)
+
+        if self.watermark is None or event_time > self.watermark:
+            self.watermark = event_time
+            for closed in [slot for slot in self.slots if slot + self.slot + self.lateness <= self.watermark]:
+                self.check(closed, 1)
+                del self.slots[closed]
+                self.closed_before = closed + self.slot
+                self.alerted = {key for key in self.alerted if key[1] > closed}
+
+        if time.monotonic() - self.last_check >= self.check_interval:
+            self.last_check = time.monotonic()
+            open_slot = floor_slot(self.watermark, self.resolution)
+            if open_slot in self.slots:
+                self.check(open_slot, (self.watermark - open_slot) / self.slot)
+
+    def check(self, slot, fraction):
+        # `fraction` is the part of the interval the events have reached
+        if slot < self.checked_from or fraction < self.min_fraction or not self.load_baseline(slot.date()):
+            return
+        time_key = slot.strftime('%H:%M:%S')
+
+        rows = []
+        for metric, aggregate in zip(self.metrics, self.slots[slot]):
+            baseline = self.baseline.get((metric.name, slot.isoweekday(), time_key))
+            value = aggregate.value()
+            if baseline is None or pd.isna(value) or (metric.name, slot) in self.alerted:
+                continue
+            expected_value = baseline.avg_relative_deviation * baseline.weighted_avg
+            relative_deviation = value / baseline.weighted_avg
+            lower_bound, upper_bound = baseline.lower_bound, baseline.upper_bound
+            if fraction < 1 and aggregate.additive is False:
+                # a distinct count may still grow, so only its excess is certain and it
+                # is compared with the bound of the whole interval, its lower bound is not checked
+                lower_bound = np.nan
+                anomaly = relative_deviation > upper_bound
+            else:
+                if fraction < 1:
+                    if aggregate.additive:
+                        # the baseline of the part of the interval which has passed
+                        relative_deviation /= fraction
+                        expected_value *= fraction
+                    # a part of the interval is noisier than the whole one, its
+                    # bounds are widened like the spread of a sample of its size
+                    widening = 1 / np.sqrt(fraction)
+                    lower_bound = baseline.avg_relative_deviation \
+                        - (baseline.avg_relative_deviation - lower_bound) * widening
+                    upper_bound = baseline.avg_relative_deviation \
+                        + (upper_bound - baseline.avg_relative_deviation) * widening
+                anomaly = not lower_bound <= relative_deviation <= upper_bound
+            rows.append({'metric_name': metric.name, 'resolution': self.resolution, 'date': slot.date().isoformat(),
+                         'time': time_key, 'value': value,
+                         'relative_deviation': relative_deviation, 'lower_bound': lower_bound,
+                         'upper_bound': upper_bound,
+                         'avg_relative_deviation': baseline.avg_relative_deviation,
+                         'expected_value': expected_value, 'anomaly': anomaly})
+
+        if rows:
+            anomalies = format_results(pd.DataFrame(rows))
+            for anomaly in anomalies.to_dict('records'):
+                self.alerted.add((anomaly['metric_name'], slot))
+                self.sink({**anomaly, 'partial': fraction < 1})
+
+
+def file_events(path, follow=False, poll_interval=1):
+    # JSON lines of events, `follow` keeps reading the lines appended to the file
+    with open(path) as file:
+        while True:
+            line = file.readline()
+            if line.strip():
+                yield json.loads(line)
+            elif not line:
+                if not follow:
+                    return
+                time.sleep(poll_interval)
+
+
+def socket_events(host, port):
+    # JSON lines of events sent over a TCP connection
+    with socket.create_connection((host, port)) as connection, connection.makefile() as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def kafka_events(topic, bootstrap_servers, group_id='anomaly_detection'):
+    # needs kafka-python, the messages are JSON events
+    from kafka import KafkaConsumer
+
+    consumer = KafkaConsumer(topic, bootstrap_servers=bootstrap_servers, group_id=group_id,
+                             value_deserializer=lambda value: json.loads(value))
+    for message in consumer:
+        yield message.value
+
+
+def events_from(source, follow=False, bootstrap_servers=None):
+    kind, _, address = source.partition(':')
+    if kind == 'file':
+        return file_events(address, follow)
+    if kind == 'socket':
+        host, port = address.rsplit(':', 1)
+        return socket_events(host, int(port))
+    if kind == 'kafka':
+        return kafka_events(address, bootstrap_servers)
+    raise ValueError(f'Unknown source {source!r}, expected file:PATH, socket:HOST:PORT or kafka:TOPIC')
+
+
+def print_alert(alert):
+    # JSON has no NaN or infinity, the values which are not known (e.g. an unchecked bound) are null
+    alert = {key: None if isinstance(value, float) and not np.isfinite(value) else value
+             for key, value in alert.items()}
+    print(json.dumps(alert, allow_nan=False), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the metrics of a table on its events as they arrive '
+                                                 'against the baseline of the anomaly detection')
+    parser.add_argument('--table', choices=list(metrics_by_table()), required=True,
+                        help='table the events come from')
+    parser.add_argument('--source', required=True, help='file:PATH, socket:HOST:PORT or kafka:TOPIC of JSON events')
+    parser.add_argument('--follow', action='store_true', help='keep reading the lines appended to the file')
+    parser.add_argument('--bootstrap-servers', help='Kafka servers, needed by a kafka source')
+    parser.add_argument('--resolution', type=int, choices=check_resolutions(RESOLUTIONS),
+                        help='length in minutes of the checked intervals, the shortest resolution by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with ClickHouseClient(connection_from_env()) as client:
+        detector = StreamDetector(client, metrics_by_table(METRICS)[args.table], print_alert, args.resolution)
+        for event in events_from(args.source, args.follow, args.bootstrap_servers):
+            detector.consume(event)
+    if detector.late_events:
+        logger.warning('Dropped %s events which arrived after their interval was closed', detector.late_events)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import logging
+import sys
+
+import numpy as np
+import pandas as pd
+
+from anomaly_detection.baseline import load_baseline
+from anomaly_detection.clickhouse import ClickHouseClient, connection_from_env
+from anomaly_detection.detection import detect_current
+from anomaly_detection.history import history_baseline
+from anomaly_detection.metrics import METRICS
+from anomaly_detection.queries import checked_window, current_queries
+
+# relative difference allowed between the statistics of the queries and of the engine
+TOLERANCE = 1e-9
+
+
+def relative_difference(left, right):
+    left, right = np.asarray(left, dtype=float), np.asarray(right, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        difference = np.abs(left - right) / np.maximum(np.maximum(np.abs(left), np.abs(right)), 1e-12)
+    # the values which are NaN on both sides are equal
+    difference[np.isnan(left) & np.isnan(right)] = 0
+    return np.nan_to_num(difference, nan=np.inf)
+
+
+def compare(sql, engine, keys, columns):
+    df = sql.merge(engine, on=keys, how='outer', suffixes=('_sql', '_engine'), indicator=True)
+    report = {'rows': len(df), 'unmatched_rows': int((df._merge != 'both').sum())}
+    both = df[df._merge == 'both']
+    for column in columns:
+        difference = relative_difference(both[f'{column}_sql'], both[f'{column}_engine'])
+        report[column] = float(difference.max()) if len(difference) else 0.0
+    return report
+
+
+def validate(client, day, metrics=METRICS):
+    # comparing the baseline and the checked current values of the
+    # baseline queries with the ones of the NumPy engine
+    sql_baseline = load_baseline(client, day, metrics).reset_index()
+    engine_baseline = history_baseline(client, day, metrics)
+    reports = {'baseline': compare(sql_baseline, engine_baseline, ['metric_name', 'resolution', 'weekday', 'time'],
+                                   ['lower_bound', 'upper_bound', 'avg_relative_deviation', 'weighted_avg'])}
+
+    results, _ = client.read_many(current_queries(metrics), checked_window())
+    current = pd.concat(results.values(), ignore_index=True)
+    if not current.empty:
+        sql_result = detect_current(client, current, metrics, baseline_source='sql', only_anomalies=False)
+        engine_result = detect_current(client, current, metrics, baseline_source='history', only_anomalies=False)
+        reports['current'] = compare(sql_result, engine_result, ['metric_name', 'resolution', 'time'],
+                                     ['relative_deviation', 'lower_bound', 'upper_bound', 'avg_relative_deviation'])
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the anomaly detection of the baseline queries '
+                                                 'with the one of the NumPy engine')
+    parser.add_argument('--day', type=lambda value: pd.Timestamp(value).date(), default=pd.Timestamp.today().date(),
+                        help='day whose baseline is compared, today by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with ClickHouseClient(connection_from_env()) as client:
+        reports = validate(client, args.day)
+
+    failed = False
+    for stage, report in reports.items():
+        print(stage, report)
+        failed |= report['unmatched_rows'] > 0 or any(value > TOLERANCE for column, value in report.items()
+                                                      if column not in ('rows', 'unmatched_rows'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()